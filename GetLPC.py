@@ -19,13 +19,27 @@ This interface uses Python 3.x, pysftp, gzip, csv,LPC_Make_Master_CSVs, readLPCX
 import sys
 import os
 import glob
-import pysftp
-import gzip
+import logging
+import concurrent.futures
+import multiprocessing
 from readLPCXML import *
 from LPC_Make_Master_CSVs import *
+from LPC_Mirror import *
+from LPC_Manifest import LPCManifest
+from LPC_Watch import *
+from LPC_Instrument import *
+from LPC_RecordCache import RecordCache
+from LPC_Resample import resample_master
+from LPC_HeaderIndex import HeaderIndex, tm_header_record
+from LPC_Pipeline import BoundedExecutor
+
+log = logging.getLogger('GetLPC')
 
 reprocess = False
 download = False
+convert = False
+retry_failed = False
+watch_mode = False
 
 if len(sys.argv) > 1:
     if sys.argv[1] == 'reprocess':
@@ -34,6 +48,15 @@ if len(sys.argv) > 1:
     if sys.argv[1] == 'download':
         download = True
         print("Downloading without processing")
+    if sys.argv[1] == 'convert':
+        convert = True
+        print("Converting all local TM files to csv")
+    if sys.argv[1] == 'retry-failed':
+        retry_failed = True
+        print("Reconverting TM files that failed to convert")
+    if sys.argv[1] == 'watch':
+        watch_mode = True
+        print("Watching the CCMz for new files")
 
 #Uncomment this line to ONLY reprocess existing csv files
 #reprocess = True
@@ -46,12 +69,36 @@ if len(sys.argv) > 1:
 default_local_target_dir="LPC_Test" # directory where to store mirrored data on your local machine
 Output_dir = "LPC/" #root dir for processed files
 LPC_csv_dir = "csv/" # subdir where to put processesed csv files 
-LPC_log_file = "LPC_Log.txt" #file to save log of XML messages
+header_index_name = "_LPC_Headers.sqlite" # index of the XML header (message ID, state messages, times) of every TM file, see LPC_HeaderIndex
+manifest_file = "LPC/LPC_Manifest.sqlite" #database of the download and processing state of every TM file
 mean_file_name = "_LPC_Mean.csv"
 master_file_name = "_LPC_Master.csv"
+stats_file_name = "_LPC_Stats.csv" # mean, std, min and max of every column for each TM file
+quality_file_name = "_LPC_Quality.csv" # framing and number of good and dropped records of each TM file
+campaign_mean_file = "LPC/LPC_Campaign_Mean.csv" # the mean files of all my_flights with a Flight column, made by reprocess
+campaign_summary_file = "LPC/LPC_Campaign_Summary.csv" # one line per flight, made by reprocess
+resample_intervals = [60, 600, 3600] # seconds, fixed interval products of each master file made by reprocess (see LPC_Resample), [] for none
+mean_time_offset = 25200 # seconds added to the mean times, adjusts from MST to UTC
 ccmz_user="XXXXXXXXX" # Your login on the CCMz
 ccmz_pass="XXXXXXXXX" # Your password on the CCMz
 my_flights=['ST2_C0_03_TTL3','ST2_C1_04_TTL3','ST2_C1_09_TTL2','ST2_C1_19_TTL3'] #All the flights with LPC
+max_workers = 4 # number of processes used to convert TM files to csv, 1 to convert serially
+columnar_output = True # also write the master and mean data to columnar stores (see LPC_Columnar)
+download_workers = 4 # number of files downloaded at once, each worker uses one SFTP connection
+pipelined = True # convert each file as soon as it is downloaded and update the master files of a flight while the next one downloads
+max_pending_conversions = 16 # downloaded files waiting to be converted before the downloads wait, in pipelined mode
+max_pending_flights = 2 # downloaded flights waiting for their master files before the next flight waits, in pipelined mode
+quick_look_plots = True # make the size distribution and HK plots of new csv files in csv_dir/plots (see LPC_Plots)
+ccmz_local_root = None # set to a local directory to mirror from a copy of the CCMz tree instead of the server (for testing)
+watch_interval = 300 # seconds between polls of the CCMz in watch mode
+watch_max_interval = 3600 # longest wait between polls when the CCMz cannot be reached
+watch_metrics_file = "LPC/LPC_Watch_Metrics.json" # per stage timing and latency in watch mode
+run_summary_file = "LPC/LPC_Run_Summary.json" # time spent in each stage and files/bytes/records processed by the last run
+log_level = "INFO" # DEBUG also logs every file converted and added to the master file, WARNING only problems
+profile_mode = None # 'cprofile' or 'tracemalloc' to profile the whole run into profile_file (and profile_file.txt)
+profile_file = "LPC/LPC_Profile.prof"
+record_cache_dir = "LPC/record_cache" # decoded TM files, so reconverting does not decompress them again (None to turn off)
+record_cache_size = 2*1024**3 # bytes, the least recently used TM files are dropped beyond this
 ########################################################################################################
 
 
@@ -62,135 +109,456 @@ tm_or_tc='TM'
 raw_or_processed='Processed'
 
 
-def mirror_ccmz_folder(instrument, ccmz_folder, local_target_dir=default_local_target_dir, show_individual_file=True):
+def ccmz_transport():
+   """
+   Transport used to reach the CCMz: the SFTP server, or a local copy of its 
+   directory tree if ccmz_local_root is set
+   """
+   if ccmz_local_root is not None:
+      return LocalTransport(ccmz_local_root)
+   return SFTPTransport(ccmz_url, ccmz_user, ccmz_pass)
+
+def mirror_ccmz_folder(instrument, ccmz_folder, local_target_dir=default_local_target_dir, show_individual_file=True, pool=None, manifest=None, flight=None, raise_errors=False, on_download=None):
    """
    Mirror one CCMz folder.
    Files are stored locally in local_target_dir/ccmz_path/to/ccmz_folder/
    Files already downloaded are not downloaded again.
    local_target_dir prescribes where CCMz files will be downloaded locally.
    show_individual_file controls whether the name of each downloaded file is displayed or not.
+   pool is a SessionPool to reuse across folders, if None a new one is opened for this folder.
+   If an LPCManifest is given, the files to download are the ones it does not list
+   as downloaded for flight, and the result of each download is recorded in it.
+   Files are downloaded download_workers at a time and only appear under their
+   final name once complete, an interrupted download is resumed on the next run.
+   If raise_errors is set a failed connection raises instead of returning None.
+   on_download(local_path) is called as each file is downloaded, before the rest are done.
    """
 
-   print('---------------------------------')
-   print('Trying to mirror CCMz folder: \033[1m'+ccmz_folder+'\033[0m')
+   log.info('mirroring ccmz_folder=%s', ccmz_folder)
    
-   downloaded_files = []
-
    # Create (if needed) the appropriate local directory
    local_folder=os.path.join(local_target_dir,ccmz_folder)
-   if not os.path.exists(local_folder):
-      os.makedirs(local_folder)
 
-   # Connect to CCMz
+   if pool is None:
+      with SessionPool(ccmz_transport(), download_workers) as pool:
+         return mirror_ccmz_folder(instrument, ccmz_folder, local_target_dir, show_individual_file, pool, manifest, flight, raise_errors, on_download)
+
+   known = None
+   if manifest is not None:
+       known = manifest.downloaded_files(flight)
+       if len(known) == 0: #first time this flight is seen with a manifest
+           manifest.import_local_files(flight, local_folder)
+           known = manifest.downloaded_files(flight)
+   def on_result(filename, size, mtime, local_path, error):
+       if manifest is not None:
+           if error is None:
+               manifest.mark_downloaded(flight, filename, local_path, size, mtime)
+           else:
+               manifest.mark_download_failed(flight, filename, size, mtime, error)
+       if error is None and on_download is not None:
+           on_download(local_path)
+
    try:
-       with pysftp.Connection(host=ccmz_url, username=ccmz_user, password=ccmz_pass) as sftp:
-          print("\033[1mConnection to CCMz succesfully established\033[0m...")
-
-          # Switch to the remote directory
-          try:
-              sftp.cwd(ccmz_folder)
-          except IOError:
-              print('\033[1m\033[91mNo such directory on CCMz: '+ccmz_folder+'\033[0m')
-              return
-
-          # Get file list in current directory, i.e. those that have been already downloaded from CCMz
-          local_files=glob.glob(os.path.join(local_folder,'*')) # filenames with relative path
-          local_filenames=[os.path.basename(f) for f in local_files] # filenames without
-
-          # Get file list from the CCMz directory with file attributes
-          ccmz_file_list = sftp.listdir_attr()
-
-          # check wether CCMz files need to be downloaded
-          n_downloads=0
-
-          for ccmz_file in ccmz_file_list:
-              # Get rid of directories in CCMZ folder (if any)
-              if ccmz_file.longname[0] == '-':
-                 ccmz_filename=ccmz_file.filename
-                 # Check whether the file has already been downloaded (so as to not download it again)
-                 if not ccmz_filename in local_filenames:
-                    # file has to be downloaded
-                    if show_individual_file == True:
-                       print('Downloading \033[92m'+ccmz_filename+'\033[0m...') # display file name
-                       downloaded_files.append(os.path.join(local_folder,ccmz_filename))
-                    sftp.get(ccmz_filename,os.path.join(local_folder,ccmz_filename),preserve_mtime=True)
-                    #print(ccmz_filename)
-                    n_downloads=n_downloads+1
-            # Create a ZipFile Object and load sample.zip in it
-                    #print (os.path.join(local_folder,ccmz_filename))
-
-            
-          # and print some statistics
-          if n_downloads == 0:
-              print('\nYour local repository \033[92m'+local_folder+'\033[0m looks\033[1m up do date\033[0m')
-          else:
-              print('\n\033[1m'+str(n_downloads)+ '\033[0m file(s) downloaded in \033[92m'+local_folder+'\033[0m')
-              print('List of downloaded Files')
-              return downloaded_files
-              
-
-   except:
-          print('\033[1m\033[91mConnection to CCMz failed\033[0m: check your login/password')
-          return
+       downloaded_files, failures = mirror_folder(pool, ccmz_folder, local_folder, download_workers, show_individual_file, known, on_result)
+   except FileNotFoundError:
+       log.error('no such directory on CCMz ccmz_folder=%s', ccmz_folder)
+       return
+   except Exception as e:
+       log.error('connection to CCMz failed, check your login/password error=%r', e)
+       if raise_errors:
+           raise
+       return
+
+   for filename, error in failures:
+       log.warning('failed to download file=%s error=%s', filename, error)
+
+   # and print some statistics
+   n_downloads = len(downloaded_files)
+   if n_downloads == 0:
+       log.info('up to date local_folder=%s', local_folder)
+   else:
+       log.info('downloaded=%d local_folder=%s', n_downloads, local_folder)
+       return downloaded_files
 
 def loop_over_flights_and_instruments():
     """
     Get all data from CCMz for the input list of flights/instruments
     """
+    if pipelined and download != True:
+        return pipelined_loop_over_flights_and_instruments()
+    with SessionPool(ccmz_transport(), download_workers) as pool, LPCManifest(manifest_file) as manifest:
+        for flight in my_flights:
+            for instrument in my_instruments:
+                process_flight_instrument(pool, flight, instrument, manifest)
+
+def process_flight_instrument(pool, flight, instrument, manifest=None):
+    """
+    Mirror one flight/instrument folder and process the new files
+    """
+    ccmz_folder=os.path.join(flight,instrument,flight_or_test,tm_or_tc,raw_or_processed)
+    #mirror_ccmz_folder(ccmz_folder)
+    new_files = mirror_ccmz_folder(instrument,ccmz_folder, show_individual_file=True, pool=pool, manifest=manifest, flight=flight)
+    if new_files != None and download != True:
+        process_new_files(flight, instrument, new_files, manifest)
+
+def process_new_files(flight, instrument, new_files, manifest=None):
+    """
+    Convert newly downloaded TM files to csv, add them to the master and mean files
+    and plot them.  The time of each stage is recorded in LPC_Instrument.metrics.
+    In watch mode this runs beside the polls, so the workers are started without
+    fork (see worker_context).
+    """
+    if os.path.exists(Output_dir + LPC_csv_dir + flight + '/') == False:
+        log.info('creating directory=%s', Output_dir + LPC_csv_dir + flight + '/')
+        os.makedirs(Output_dir + LPC_csv_dir + flight + '/')
+    
+    if 'LPC' == instrument:
+        with metrics.stage('convert'):
+            csv_files, failures = convert_tm_files(new_files, Output_dir + LPC_csv_dir + flight + '/', Output_dir + flight + header_index_name, manifest=manifest, flight=flight,
+                                                      mp_context=worker_context())
+    
+    update_flight_files(flight, mp_context=worker_context())
+
+def update_flight_files(flight, mp_context=None):
+    """
+    Add the new csv files of a flight to its master and mean files and plot them,
+    starting the plotting processes with mp_context (the default start method if None)
+    """
+    with metrics.stage('master'):
+        master_csv(Output_dir + LPC_csv_dir + flight + '/' + "*.csv",Output_dir + flight + mean_file_name, Output_dir + flight + master_file_name, incremental = True, columnar = columnar_output,
+                   stats_file_name = Output_dir + flight + stats_file_name, time_offset = mean_time_offset)
+    if quick_look_plots:
+        from LPC_Plots import plot_csv_files  #imported here so the conversion workers, which import this module, do not load matplotlib
+        plot_csv_files(glob.glob(Output_dir + LPC_csv_dir + flight + '/' + "*.csv"), max_workers, mp_context=mp_context)
+
+def worker_context():
+    """
+    Start method of the process pools of the pipelined loop and of watch mode.  A
+    forked child inherits the locks held at that moment by the download, poll and
+    master file threads (metrics, logging) and can hang on them, so the workers
+    start from a fresh process instead.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+def pipelined_loop_over_flights_and_instruments():
+    """
+    Same as loop_over_flights_and_instruments with the network and the CPUs busy at
+    the same time: each TM file is queued for conversion in a pool of max_workers
+    processes as soon as its download completes, and each flight is added to its
+    master files and plotted on a background thread while the next one downloads.
+    At most max_pending_conversions files and max_pending_flights flights wait for
+    processing, beyond that the downloads wait.  A flight whose download fails part way
+    is still processed for the files queued before the failure.
+    """
+    with SessionPool(ccmz_transport(), download_workers) as pool, LPCManifest(manifest_file) as manifest, \
+         concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=reset_metrics, mp_context=worker_context()) as workers:
+        converter = BoundedExecutor(workers, max_pending_conversions)
+        processing = ProcessingQueue(finish_flight_instrument, metrics, max_pending_flights)
+        try:
+            for flight in my_flights:
+                for instrument in my_instruments:
+                    ccmz_folder=os.path.join(flight,instrument,flight_or_test,tm_or_tc,raw_or_processed)
+                    csv_dir = Output_dir + LPC_csv_dir + flight + '/'
+                    if os.path.exists(csv_dir) == False:
+                        log.info('creating directory=%s', csv_dir)
+                        os.makedirs(csv_dir)
+                    conversions = []
+                    def on_download(InputFile):
+                        if 'LPC' == instrument and InputFile.endswith('.gz'):
+                            OutputFile = csv_name_for_tm(InputFile, csv_dir)
+                            conversions.append(((InputFile, OutputFile), converter.submit(convert_tm_file, InputFile, OutputFile, record_cache_dir)))
+                    new_files = None
+                    try:
+                        new_files = mirror_ccmz_folder(instrument,ccmz_folder, show_individual_file=True, pool=pool, manifest=manifest, flight=flight, on_download=on_download)
+                    finally:
+                        if new_files != None or len(conversions) > 0: #keep the conversions already started if the download failed
+                            processing.put(flight, instrument, conversions)
+        finally:
+            processing.close() #finishes the flights already queued
+
+def finish_flight_instrument(flight, instrument, conversions):
+    """
+    Collect the conversions of a flight started by pipelined_loop_over_flights_and_instruments
+    (a list of ((TM file, csv file), future)) and update its master files and plots
+    """
+    with LPCManifest(manifest_file) as manifest: #sqlite connections stay on the thread that opened them
+        if 'LPC' == instrument:
+            with metrics.stage('convert'):
+                jobs = [job for job, future in conversions]
+                record_conversions(jobs, [conversion_result(future) for job, future in conversions], Output_dir + LPC_csv_dir + flight + '/',
+                                   Output_dir + flight + header_index_name, manifest, flight, record_cache_dir)
+    update_flight_files(flight, mp_context=worker_context()) #runs beside the downloads, see worker_context
+
+def watch(max_polls=None):
+    """
+    Poll the CCMz every watch_interval seconds (backing off up to watch_max_interval
+    while it cannot be reached) and process new files on a background thread while
+    the next poll runs.  Stage timings and the latency of each file, from when it
+    was written on the CCMz to when it is in the master files, are saved to
+    watch_metrics_file.  Runs until interrupted, or for max_polls polls.
+    """
+    pool = SessionPool(ccmz_transport(), download_workers)
+    
+    def poll():
+        jobs = []
+        errors = []
+        with LPCManifest(manifest_file) as manifest:
+            for flight in my_flights:
+                for instrument in my_instruments:
+                    ccmz_folder=os.path.join(flight,instrument,flight_or_test,tm_or_tc,raw_or_processed)
+                    try:
+                        new_files = mirror_ccmz_folder(instrument,ccmz_folder, show_individual_file=True, pool=pool, manifest=manifest, flight=flight, raise_errors=True)
+                    except Exception as e: #the files already downloaded this poll are marked in the manifest, so keep their jobs
+                        errors.append(e)
+                        continue
+                    if new_files != None:
+                        jobs.append((flight, instrument, new_files))
+        if len(errors) > 0:
+            pool.close() #reconnect on the next poll
+            raise PollError(errors[0], jobs)
+        return jobs
+    
+    def process(flight, instrument, new_files):
+        with LPCManifest(manifest_file) as manifest: #sqlite connections stay on the thread that opened them
+            process_new_files(flight, instrument, new_files, manifest)
+        metrics.record_latency(new_files)
+        metrics.write(watch_metrics_file)
+    
+    processing = ProcessingQueue(process, metrics)
+    try:
+        watch_loop(poll, processing, Backoff(watch_interval, watch_max_interval), metrics, watch_metrics_file, max_polls)
+    finally:
+        processing.close() #finishes the batches already queued
+        pool.close()
+    metrics.write(watch_metrics_file)
+    return metrics
+
+def csv_name_for_tm(InputFile, csv_dir):
+    """
+    Name of the csv file for a TM file: xxx.LPC.dat.gz -> csv_dir/xxx.LPC.csv
+    """
+    OutputFile = os.path.join(csv_dir, os.path.splitext(os.path.basename(InputFile))[0])
+    return os.path.splitext(OutputFile)[0] + '.csv'
+
+def convert_tm_file(InputFile, OutputFile, cache_dir=None):
+    """
+    Read the state message and convert one TM file to csv, decompressing it only once,
+    or not at all if it is in the RecordCache in cache_dir.
+    Runs in a worker process, so errors are returned as (stage, message) tuples rather
+    than raised, and the timers and counters it recorded are returned to be merged
+    into the parent's metrics along with the header record and quality of the file
+    (see readTM).
+    """
+    header = None
+    csvFile = None
+    errors = []
+    try:
+        TM = readTM(InputFile) if cache_dir is None else RecordCache(cache_dir).read_tm(InputFile)
+    except Exception as e:
+        return header, csvFile, 0, [('read', repr(e))], metrics.take(), None
+    try:
+        if os.path.basename(InputFile).startswith('ST2') and (TM['MsgID'] is None or TM['StateMess1'] is None):
+            raise ValueError('No <Msg> or <StateMess1> in the header of ' + os.path.basename(InputFile))
+        header = tm_header_record(TM)
+    except Exception as e:
+        errors.append(('header', repr(e)))
+    try:
+        csvFile = writeLPCcsv(TM, OutputFile)
+    except Exception as e:
+        errors.append(('parse', repr(e)))
+    
+    return header, csvFile, len(TM['records']), errors, metrics.take(), TM['quality']
+
+def update_quality_file(quality_file, qualities):
+    """
+    Add the quality of each TM file in the dict qualities (TM file name: quality
+    dict from readTM) to the csv quality_file, replacing earlier lines for the same
+    files, and warn about the files that had records dropped or were badly framed
+    """
+    columns = ['framing', 'records', 'bad_time', 'sentinel', 'partial_bytes']
+    lines = dict()
+    if os.path.exists(quality_file):
+        with open(quality_file) as f:
+            next(f, None)
+            for line in f:
+                lines[line.split(',')[0]] = line
+    for name, quality in qualities.items():
+        lines[name] = ','.join([name] + [str(quality[c]) for c in columns]) + '\n'
+        if quality['framing'] != 'length' or quality['bad_time'] > 0 or quality['sentinel'] > 0 or quality['partial_bytes'] > 0:
+            log.warning('damaged file=%s framing=%s records=%d bad_time=%d sentinel=%d partial_bytes=%d', name,
+                        *[quality[c] for c in columns])
+    with open(quality_file, 'w') as f:
+        f.write('File,Framing,Records,Bad_Time,Sentinel,Partial_Bytes\n')
+        for name in sorted(lines):
+            f.write(lines[name])
+
+def convert_tm_files(tm_files, csv_dir, header_index_file, max_workers=max_workers, manifest=None, flight=None, cache_dir=record_cache_dir, mp_context=None):
+    """
+    Convert a batch of TM files to csv files in csv_dir using a pool of max_workers 
+    processes.  The header record of every file (message ID, state messages, times)
+    is saved to the HeaderIndex header_index_file.  Returns the list of csv files
+    written and a list of (TM file, stage, error) tuples for the files that failed.  If an
+    LPCManifest is given the parse state of each file is recorded for flight.
+    Decoded files are cached in cache_dir, which is trimmed to record_cache_size.
+    The quality of each file is kept in Output_dir + <csv_dir name> + quality_file_name.
+    The worker processes are started with mp_context (the default start method if None).
+    """
+    tm_files = sorted(f for f in tm_files if f.endswith('.gz'))
+    jobs = [(f, csv_name_for_tm(f, csv_dir)) for f in tm_files]
+    results = []
+    
+    if max_workers == 1 or len(jobs) < 2:
+        for InputFile, OutputFile in jobs:
+            results.append(convert_tm_file(InputFile, OutputFile, cache_dir))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=reset_metrics, mp_context=mp_context) as pool:
+            futures = [pool.submit(convert_tm_file, InputFile, OutputFile, cache_dir) for InputFile, OutputFile in jobs]
+            results = [conversion_result(future) for future in futures]
+    
+    return record_conversions(jobs, results, csv_dir, header_index_file, manifest, flight, cache_dir)
+
+def conversion_result(future):
+    """
+    The result of convert_tm_file run in a worker process, or a failure if the worker itself died
+    """
+    try:
+        return future.result()
+    except Exception as e:
+        return None, None, 0, [('worker', repr(e))], None, None
+
+def record_conversions(jobs, results, csv_dir, header_index_file, manifest=None, flight=None, cache_dir=record_cache_dir):
+    """
+    Merge the metrics, log the failures and save the header records, parse states
+    and quality of the (TM file, csv file) jobs converted by convert_tm_file, see
+    convert_tm_files.  Returns the list of csv files written and the list of failures.
+    """
+    csv_files = []
+    failures = []
+    qualities = dict()
+    headers = []
+    for (InputFile, OutputFile), (header, csvFile, rows, errors, recorded, quality) in zip(jobs, results):
+        if recorded is not None:
+            metrics.merge(recorded)
+        if quality is not None:
+            qualities[os.path.basename(InputFile)] = quality
+        if header is not None:
+            headers.append((InputFile, header))
+        if csvFile is not None:
+            csv_files.append(csvFile)
+        for stage, error in errors:
+            failures.append((InputFile, stage, error))
+        if manifest is not None:
+            if csvFile is not None:
+                manifest.mark_parsed(flight, os.path.basename(InputFile), rows)
+            else:
+                manifest.mark_parse_failed(flight, os.path.basename(InputFile), '; '.join(stage + ': ' + error for stage, error in errors))
+    
+    for InputFile, stage, error in failures:
+        log.warning('unable to ' + {'read': 'read', 'header': 'read header from'}.get(stage, 'process data from') + ' file=%s error=%s', os.path.basename(InputFile), error)
+    log.info('converted=%d of=%d', len(csv_files), len(jobs))
+    with HeaderIndex(header_index_file) as header_index:
+        header_index.put(headers)
+    if len(qualities) > 0:
+        update_quality_file(Output_dir + os.path.basename(os.path.normpath(csv_dir)) + quality_file_name, qualities)
+    if cache_dir is not None:
+        RecordCache(cache_dir, record_cache_size).evict()
+    
+    return csv_files, failures
+
+def convert_all_flights(max_workers=max_workers):
+    """
+    Reconvert every TM file already mirrored locally for each flight
+    """
     for flight in my_flights:
         for instrument in my_instruments:
-            ccmz_folder=os.path.join(flight,instrument,flight_or_test,tm_or_tc,raw_or_processed)
-            #mirror_ccmz_folder(ccmz_folder)
-            new_files = mirror_ccmz_folder(instrument,ccmz_folder, show_individual_file=True)
-            if new_files != None and download != True:
-                if os.path.exists(LPC_csv_dir + flight + '/') == False:
-                    print('Creating Directory: ' + LPC_csv_dir + flight + '/')
-                    os.makedirs(LPC_csv_dir + flight + '/')
-                for file in new_files:
-                    if file.endswith('.gz'):
-                        path = os.path.dirname(file)
-                        filename = os.path.basename(file)
-                    
-                    if 'LPC' == instrument:
-                        InputFile = path + '/' + filename
-                        #print('Input Filename: ' + InputFile)
-                        try:
-                            readHeader(InputFile,LPC_log_file)
-                        except:
-                            print("Unable to read header from: " + os.path.basename(file))
-                        try:
-                            OutputFile = Output_dir + LPC_csv_dir + flight + '/' + os.path.splitext(os.path.basename(file))[0]
-                            OutputFile = os.path.splitext(OutputFile)[0] + '.csv'
-                            print('Processing to: ' + OutputFile)
-                            csvFile = parseLCPdatatoCSV(InputFile,OutputFile)
-                            #plotLPC(csvFile)
-                        except:
-                            print('Unable to Process Data From: ' + os.path.basename(file) )
-                
-                
-                master_csv(Output_dir + LPC_csv_dir + '/' + flight + '/'+  "*.csv",Output_dir + flight + mean_file_name, Output_dir + flight + master_file_name)
-                        
-
-def readHeader(InputFile,logFile):    
+            local_folder = os.path.join(default_local_target_dir,flight,instrument,flight_or_test,tm_or_tc,raw_or_processed)
+            tm_files = glob.glob(os.path.join(local_folder,'*.gz'))
+            if len(tm_files) == 0 or 'LPC' != instrument:
+                continue
+            csv_dir = Output_dir + LPC_csv_dir + flight + '/'
+            if os.path.exists(csv_dir) == False:
+                log.info('creating directory=%s', csv_dir)
+                os.makedirs(csv_dir)
+            convert_tm_files(tm_files, csv_dir, Output_dir + flight + header_index_name, max_workers)
+            master_csv(csv_dir + "*.csv",Output_dir + flight + mean_file_name, Output_dir + flight + master_file_name, columnar = columnar_output,
+                       stats_file_name = Output_dir + flight + stats_file_name, time_offset = mean_time_offset)
+            if quick_look_plots:
+                from LPC_Plots import plot_csv_files
+                plot_csv_files(glob.glob(csv_dir + "*.csv"), max_workers)
+
+def reprocess_flight(flight):
+    """
+    Rebuild the master and mean files of one flight from its csv files, and its
+    resampled products for resample_intervals.  Runs in a worker process, so an
+    error is returned rather than raised along with the timers and counters it
+    recorded.
+    """
+    error = None
+    try:
+        master_csv(Output_dir + LPC_csv_dir + flight + '/' + "*.csv",Output_dir + flight + mean_file_name, Output_dir + flight + master_file_name, columnar = columnar_output,
+                   stats_file_name = Output_dir + flight + stats_file_name, time_offset = mean_time_offset)
+        if len(resample_intervals) > 0:
+            resample_master(Output_dir + flight + master_file_name, resample_intervals)
+    except Exception as e:
+        error = repr(e)
+    return flight, error, metrics.take()
+
+def reprocess_all_flights(max_workers=max_workers):
+    """
+    Rebuild the master and mean files of every flight in my_flights, one worker
+    process per flight (up to max_workers), then combine them into the campaign
+    mean and summary files
+    """
+    flights = [flight for flight in my_flights if os.path.exists(Output_dir + LPC_csv_dir + flight + '/')]
+    if max_workers == 1 or len(flights) < 2:
+        results = [reprocess_flight(flight) for flight in flights]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(flights)), initializer=reset_metrics) as pool:
+            results = list(pool.map(reprocess_flight, flights))
     
-    with gzip.open(InputFile, "rb") as binary_file:
-        data = binary_file.read()
-    start = data.find(b'<StateMess1>')
-    end = data.find(b'</StateMess1>')
-    XMLMsg = data[start+12:end].decode()
-    start = data.find(b'<Msg>')
-    end = data.find(b'</Msg>')
-    MsgID = data[start+5:end].decode()
+    for flight, error, recorded in results:
+        metrics.merge(recorded)
+        if error is not None:
+            log.error('unable to reprocess flight=%s error=%s', flight, error)
     
-    if os.path.basename(InputFile).startswith('ST2'):
-        #print(os.path.basename(InputFile))
-        #print(MsgID + ' ' + XMLMsg)
-        
-        with open(logFile, "a") as log:
-            log.write(os.path.basename(InputFile) + ': ' + MsgID + ' ' + XMLMsg + '\n')                        
+    with metrics.stage('campaign'):
+        n = combine_flights([(flight, Output_dir + flight + mean_file_name, Output_dir + flight + master_file_name)
+                             for flight, error, recorded in results if error is None],
+                            campaign_mean_file, campaign_summary_file)
+    log.info('reprocessed flights=%d campaign_mean=%s campaign_summary=%s', n, campaign_mean_file, campaign_summary_file)
+
+def retry_failed_files(max_workers=max_workers):
+    """
+    Reconvert only the TM files the manifest lists as failed, then update the
+    master and mean files of the flights that had any
+    """
+    with LPCManifest(manifest_file) as manifest:
+        for flight in my_flights:
+            tm_files = manifest.failed_files(flight)
+            if len(tm_files) == 0:
+                continue
+            log.info('retrying failed_files=%d flight=%s', len(tm_files), flight)
+            csv_dir = Output_dir + LPC_csv_dir + flight + '/'
+            if os.path.exists(csv_dir) == False:
+                os.makedirs(csv_dir)
+            csv_files, failures = convert_tm_files(tm_files, csv_dir, Output_dir + flight + header_index_name, max_workers, manifest, flight)
+            if len(csv_files) > 0:
+                master_csv(csv_dir + "*.csv",Output_dir + flight + mean_file_name, Output_dir + flight + master_file_name, incremental = True, columnar = columnar_output,
+                           stats_file_name = Output_dir + flight + stats_file_name, time_offset = mean_time_offset)
 
 if __name__ == '__main__':
-    if reprocess:
-        master_csv(LPC_csv_dir + "*.csv",mean_file_name,master_file_name)
-    else:
-        loop_over_flights_and_instruments()
+    logging.basicConfig(level=log_level, format='%(asctime)s %(levelname)s %(name)s %(message)s')
+    with profiled(profile_mode, profile_file):
+        if reprocess:
+            reprocess_all_flights()
+        elif convert:
+            convert_all_flights()
+        elif retry_failed:
+            retry_failed_files()
+        elif watch_mode:
+            watch(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+        else:
+            loop_over_flights_and_instruments()
+    metrics.write(run_summary_file, {'mode': sys.argv[1] if len(sys.argv) > 1 else 'mirror'})
+    log.info('run summary in %s: %s', run_summary_file, metrics.report())
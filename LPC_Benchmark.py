@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the LPC processing chain.
+
+Compares the vectorized record decoder in readLPCXML against the original
+per-record struct.unpack_from loop, and checks that both produce identical
+csv rows.  With 'synthetic' it writes a set of synthetic TM files (see
+LPC_Synthetic) and times each stage of the processing chain on them, reporting
+throughput in records per second and the peak memory allocated by each stage.
+
+Usage: python3 LPC_Benchmark.py TM_file.gz [TM_file.gz ...]
+       python3 LPC_Benchmark.py synthetic [n_files] [n_records] [results.json]
+"""
+
+import os
+import sys
+import glob
+import gzip
+import json
+import struct
+import tempfile
+import time
+import tracemalloc
+from readLPCXML import *
+from LPC_Make_Master_CSVs import master_csv
+from LPC_Synthetic import make_flight
+from LPC_Plots import plot_csv_files
+
+
+def parseRecordsLoop(data):
+    ''' The original per-record decoder from parseLCPdatatoCSV, kept as a reference '''
+    rows = []
+    for y in range(int(len(data)/96 -1)):
+        HGBins = []
+        LGBins = []
+        HKRaw = []
+        HKData = [0]*15
+        indx = 36 + (y+1)*96
+
+        for x in range(16):
+            HGBins.append(struct.unpack_from('>H',data,indx + x*2)[0])
+            LGBins.append(struct.unpack_from('>H',data,indx + x*2 + 32)[0])
+            HKRaw.append(struct.unpack_from('>H',data,indx + x*2 + 64)[0])
+
+        HKData[0] = HKRaw[0] + HKRaw[1]*65535  # 16 LSB of time_t
+        HKData[1] = HKRaw[2]  # Pump1 Current in mA
+        HKData[2] = HKRaw[3]  # Pump2 Current in mA
+        HKData[3] = HKRaw[4]  # Heater1 Current in mA
+        HKData[4] = HKRaw[5]  # Detector Current in mA
+        HKData[5] = HKRaw[6] / 1000.0 # Detector voltage in V
+        HKData[6] = HKRaw[7] / 1000.0 # Input Voltage
+        HKData[7] = HKRaw[8] / 1000.0 #Input V
+        HKData[8] = HKRaw[9] / 1000.0 # Flow in SLPM
+        HKData[9] = HKRaw[10] / 1000.0 # Motor voltage in V
+        HKData[10] = HKRaw[11] / 100.0 - 273.15 # Pump1 T in C
+        HKData[11] = HKRaw[12] / 100.0 - 273.15 # Pump2 T in C
+        HKData[12] = HKRaw[13] / 100.0 - 273.15 # Laser T in C
+        HKData[13] = HKRaw[14] / 100.0 - 273.15 # DC-DC T in C
+        HKData[14] = HKRaw[15] / 100.0 - 273.15 # Inlet T in C
+
+        rows.append(HKData + HGBins + LGBins)
+    return rows
+
+def readBinarySection(InputFile):
+    ''' Return the bytes between START and END of a gzipped TM file '''
+    with gzip.open(InputFile, "rb") as binary_file:
+        bindata = binary_file.read()
+    return bindata[bindata.find(b'START') + 5:bindata.find(b'END')]
+
+def timeit(func, data, repeats):
+    ''' Best wall time of repeats calls of func(data) '''
+    best = float('inf')
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        result = func(data)
+        best = min(best, time.perf_counter() - t0)
+    return best, result
+
+def benchmark_decode(filenames, repeats=5):
+    ''' Time the loop and vectorized decoders over the binary sections of filenames '''
+    sections = [readBinarySection(f) for f in filenames]
+    loop_time = 0.0
+    vec_time = 0.0
+    n_records = 0
+    for data in sections:
+        t_loop, loop_rows = timeit(parseRecordsLoop, data, repeats)
+        t_vec, vec_rows = timeit(lambda d: LPCrecordRows(decodeLPCrecords(d)), data, repeats)
+        if loop_rows != vec_rows:
+            raise ValueError('Vectorized decoder output differs from the per-record loop')
+        loop_time += t_loop
+        vec_time += t_vec
+        n_records += len(loop_rows)
+
+    print('Files: ' + str(len(sections)) + ' Records: ' + str(n_records))
+    print('Per-record loop: ' + "{:.4f}".format(loop_time) + ' s, ' + "{:.0f}".format(n_records/max(loop_time,1e-12)) + ' records/s')
+    print('Vectorized:      ' + "{:.4f}".format(vec_time) + ' s, ' + "{:.0f}".format(n_records/max(vec_time,1e-12)) + ' records/s')
+    print('Speedup: ' + "{:.1f}".format(loop_time/max(vec_time,1e-12)) + 'x')
+    return loop_time, vec_time
+
+def run_stage(name, func, n_records):
+    """
+    Run func twice, once timed and once under tracemalloc (which slows it down),
+    returning a dict with its wall time, throughput and the peak memory allocated
+    """
+    t0 = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - t0
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {'stage': name, 'seconds': elapsed, 'records': n_records,
+              'records_per_s': n_records / max(elapsed, 1e-12), 'peak_MB': peak / 1e6}
+    print('{:<12} {:>9.3f} s {:>12.0f} records/s {:>9.1f} MB peak'.format(
+        name, elapsed, result['records_per_s'], result['peak_MB']))
+    return result
+
+def benchmark_chain(n_files = 20, n_records = 360, n_plots = 2, work_dir = None):
+    """
+    Time decoding, csv writing, master/mean aggregation and plotting on n_files
+    synthetic TM files of n_records records each.  Returns a list of per-stage
+    results.
+    """
+    with tempfile.TemporaryDirectory(dir = work_dir) as tmp:
+        tm_files = make_flight(os.path.join(tmp, 'TM'), n_files, n_records)
+        csv_dir = os.path.join(tmp, 'csv')
+        os.makedirs(os.path.join(csv_dir, 'plots'))
+        csv_files = [os.path.join(csv_dir, os.path.basename(f)[:-len('.dat.gz')] + '.csv') for f in tm_files]
+        total = n_files * n_records
+
+        print('Files: ' + str(n_files) + ' Records per file: ' + str(n_records))
+        results = []
+        results.append(run_stage('decode', lambda: [readTM(f) for f in tm_files], total))
+        results.append(run_stage('csv write', lambda: [parseLCPdatatoCSV(f, c) for f, c in zip(tm_files, csv_files)], total))
+        results.append(run_stage('master/mean', lambda: master_csv(os.path.join(csv_dir, '*.csv'),
+                       os.path.join(tmp, 'Mean.csv'), os.path.join(tmp, 'Master.csv')), total))
+        results.append(run_stage('plot', lambda: plot_csv_files(csv_files[:n_plots], max_workers = 1, force = True), n_plots * n_records))
+    return results
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 LPC_Benchmark.py TM_file.gz [TM_file.gz ...]')
+        print('       python3 LPC_Benchmark.py synthetic [n_files] [n_records] [results.json]')
+        return
+    if sys.argv[1] == 'synthetic':
+        n_files = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+        n_records = int(sys.argv[3]) if len(sys.argv) > 3 else 360
+        results = benchmark_chain(n_files, n_records)
+        if len(sys.argv) > 4:
+            with open(sys.argv[4], 'w') as f:
+                json.dump(results, f, indent = 1)
+        return
+    benchmark_decode(sys.argv[1:])
+
+if __name__ == "__main__":
+    main()
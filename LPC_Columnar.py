@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar binary store for the LPC master and mean datasets.
+
+A store is a directory with one raw little-endian float64 file per column and
+an index.json that lists the columns, the number of rows and one chunk per TM
+file (source csv, first row, row count, time range and the min/max of each HK
+column, used by LPC_Query to skip chunks).  Columns are appended
+one chunk at a time and loaded back as memory-mapped arrays, so reading a
+whole flight does not need any text parsing.  The 32 size bins are stored as a
+single 'Bins' column of width 32.
+
+The index is written after the column files, so rows past the count in the
+index (e.g. from an interrupted write) are ignored and trimmed on the next append.
+A StoreWriter keeps the index in memory while it appends and writes it every
+flush_chunks chunks and when it is closed.
+"""
+
+import os
+import csv
+import json
+import numpy as np
+from readLPCXML import LPC_HK_FIELDS
+
+#Layout of the master file rows (15 HK columns then 32 bins) and the mean file rows (plus NaN count)
+MASTER_COLUMNS = [(name, 1) for name in LPC_HK_FIELDS] + [('Bins', 32)]
+MEAN_COLUMNS = MASTER_COLUMNS + [('NaNs', 1)]
+
+
+def columnar_store_name(csv_file):
+    """
+    Name of the store that goes with a master or mean csv file
+    """
+    return os.path.splitext(csv_file)[0] + '_store'
+
+def column_file(store_dir, name):
+    return os.path.join(store_dir, name + '.f8')
+
+def read_store_index(store_dir):
+    """
+    Read the index of a store
+    """
+    with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+        return json.load(f)
+
+def write_store_index(store_dir, index):
+    tmp = os.path.join(store_dir, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent = 1)
+    os.replace(tmp, os.path.join(store_dir, 'index.json'))
+
+def create_store(store_dir, columns, header = ''):
+    """
+    Create an empty store with columns, a list of (name, width) tuples.  header is
+    the csv header text used when exporting the store back to csv.
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    for name, width in columns:
+        open(column_file(store_dir, name), 'wb').close()
+    index = {'columns': [[name, width] for name, width in columns], 'rows': 0,
+             'header': header, 'chunks': []}
+    write_store_index(store_dir, index)
+    return index
+
+class StoreWriter:
+    """
+    Appends chunks to an existing store, keeping its index and column files open.
+    The index is written every flush_chunks chunks and on close, so writing a flight
+    of thousands of TM files does not rewrite the index for each of them.
+    """
+    def __init__(self, store_dir, flush_chunks = 256):
+        self.store_dir = store_dir
+        self.flush_chunks = flush_chunks
+        self.index = read_store_index(store_dir)
+        self.files = []
+        for name, width in self.index['columns']:
+            f = open(column_file(store_dir, name), 'r+b')
+            f.truncate(self.index['rows'] * width * 8)  #drop anything not in the index
+            f.seek(0, os.SEEK_END)
+            self.files.append(f)
+        self.unflushed = 0
+
+    def append(self, source, data, extend = False):
+        """
+        Append the rows of a 2D array (one column per field, bins expanded) as one
+        chunk from the file source.  With extend = True the rows are added to the last
+        chunk if it came from the same source, so a file can be written in several batches.
+        """
+        index = self.index
+        data = np.asarray(data, dtype = '<f8').reshape(-1, sum(w for n, w in index['columns']))
+        col = 0
+        mins = []
+        maxs = []
+        for (name, width), f in zip(index['columns'], self.files):
+            if width == 1:
+                values = data[:, col]
+                values = values[~np.isnan(values)]
+                mins.append(float(values.min()) if len(values) else None)
+                maxs.append(float(values.max()) if len(values) else None)
+            np.ascontiguousarray(data[:, col:col+width]).tofile(f)
+            col += width
+
+        t0 = mins[0]
+        t1 = maxs[0]
+        chunks = index['chunks']
+        if extend and len(chunks) > 0 and chunks[-1]['source'] == source:
+            chunk = chunks[-1]
+            chunk['rows'] += len(data)
+            if t0 is not None:
+                chunk['t0'] = t0 if chunk['t0'] is None else min(chunk['t0'], t0)
+                chunk['t1'] = t1 if chunk['t1'] is None else max(chunk['t1'], t1)
+            chunk['min'] = [a if b is None else b if a is None else min(a, b) for a, b in zip(chunk['min'], mins)]
+            chunk['max'] = [a if b is None else b if a is None else max(a, b) for a, b in zip(chunk['max'], maxs)]
+        else:
+            chunks.append({'source': source, 'start': index['rows'], 'rows': len(data), 't0': t0, 't1': t1,
+                           'min': mins, 'max': maxs})
+            self.unflushed += 1
+        index['rows'] += len(data)
+        if self.unflushed >= self.flush_chunks:
+            self.flush()
+        return index
+
+    def flush(self):
+        """
+        Write the column files, then the index
+        """
+        for f in self.files:
+            f.flush()
+        write_store_index(self.store_dir, self.index)
+        self.unflushed = 0
+
+    def close(self):
+        if len(self.files) > 0:
+            self.flush()
+            for f in self.files:
+                f.close()
+            self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def append_chunk(store_dir, source, data, extend = False):
+    """
+    Append one chunk to a store and write its index, see StoreWriter.append.  Use a
+    StoreWriter to append many chunks.
+    """
+    with StoreWriter(store_dir) as writer:
+        return writer.append(source, data, extend)
+
+def load_store(store_dir, columns = None, mmap = True):
+    """
+    Load a store as a dict of named columns, all the HK fields as 1D arrays and
+    'Bins' as an N x 32 array.  With mmap = True the columns are read-only memory
+    maps, so only the parts that are used are read from disk.  columns optionally
+    restricts which columns are loaded.
+    """
+    index = read_store_index(store_dir)
+    rows = index['rows']
+    store = dict()
+    for name, width in index['columns']:
+        if columns is not None and name not in columns:
+            continue
+        shape = (rows,) if width == 1 else (rows, width)
+        if rows == 0:
+            store[name] = np.zeros(shape)
+        elif mmap:
+            store[name] = np.memmap(column_file(store_dir, name), dtype = '<f8', mode = 'r', shape = shape)
+        else:
+            store[name] = np.fromfile(column_file(store_dir, name), dtype = '<f8', count = rows * width).reshape(shape)
+    return store
+
+def store_rows(store_dir):
+    """
+    Return the data of a store as a single 2D array in csv column order
+    """
+    index = read_store_index(store_dir)
+    store = load_store(store_dir)
+    columns = [store[name].reshape(index['rows'], width) for name, width in index['columns']]
+    return np.concatenate(columns, axis = 1)
+
+def export_master_csv(store_dir, master_file_name):
+    """
+    Write a master store out as a master csv file
+    """
+    index = read_store_index(store_dir)
+    with open(master_file_name, 'w', newline = '') as outfile:
+        outfile.write(index['header'])
+    with open(master_file_name, 'ab') as f:
+        np.savetxt(f, store_rows(store_dir), delimiter = ",")
+
+def export_mean_csv(store_dir, mean_file_name):
+    """
+    Write a mean store out as a mean csv file
+    """
+    index = read_store_index(store_dir)
+    with open(mean_file_name, 'w', newline = '') as outfile:
+        outfile.write(index['header'])
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerows(store_rows(store_dir))
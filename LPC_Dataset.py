@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lazily loaded LPC datasets.
+
+LPCDataset wraps a master or mean csv file with a memory-mapped columnar store
+(see LPC_Columnar).  If master_csv wrote a store next to the csv file and it is
+up to date, that store is used directly.  Otherwise the csv is converted once to
+a cache store next to it, which is rebuilt whenever the csv is newer than the
+cache.  Only the rows that are actually used are read from disk.
+"""
+
+import os
+import itertools
+import numpy as np
+from LPC_Columnar import *
+
+
+def cache_store_name(csv_file):
+    """
+    Name of the cache store built from a csv file
+    """
+    return os.path.splitext(csv_file)[0] + '_cache'
+
+def store_is_current(store_dir, csv_file):
+    """
+    True if the store exists and was written after the csv file was last modified
+    """
+    index_file = os.path.join(store_dir, 'index.json')
+    return os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(csv_file)
+
+def build_cache_store(csv_file, store_dir, block_rows = 100000):
+    """
+    Convert a master or mean csv file to a columnar store, block_rows lines at a time
+    """
+    writer = None
+    with open(csv_file, 'r') as f:
+        header = f.readline() + f.readline()
+        try:
+            while True:
+                lines = list(itertools.islice(f, block_rows))
+                if len(lines) == 0:
+                    break
+                data = np.loadtxt(lines, delimiter = ',', ndmin = 2)
+                if writer is None:
+                    columns = MASTER_COLUMNS if data.shape[1] == 47 else MEAN_COLUMNS
+                    create_store(store_dir, columns, header)
+                    writer = StoreWriter(store_dir)
+                writer.append(csv_file, data)
+        finally:
+            if writer is not None:
+                writer.close()
+    if writer is None:
+        create_store(store_dir, MASTER_COLUMNS, header)
+
+class LPCDataset:
+    """
+    Memory-mapped view of a master or mean csv file, or of a columnar store
+    directory such as a resampled product (see LPC_Resample)
+    """
+    def __init__(self, csv_file):
+        self.csv_file = csv_file
+        store_dir = columnar_store_name(csv_file)
+        if os.path.isdir(csv_file):
+            store_dir = csv_file
+        elif not store_is_current(store_dir, csv_file):
+            store_dir = cache_store_name(csv_file)
+            if not store_is_current(store_dir, csv_file):
+                print('Building cache of ' + csv_file + ' in ' + store_dir)
+                build_cache_store(csv_file, store_dir)
+        self.store_dir = store_dir
+        self.index = read_store_index(store_dir)
+        self.columns = load_store(store_dir)
+
+    def __len__(self):
+        return self.index['rows']
+
+    def column(self, name):
+        """
+        Memory-mapped array of one column, e.g. 'Flow' or 'Bins'
+        """
+        return self.columns[name]
+
+    def scan(self, i):
+        """
+        Return one record as a dict of HK values (floats) and 'Bins' (32 values)
+        """
+        record = dict()
+        for name, values in self.columns.items():
+            record[name] = np.array(values[i]) if values.ndim > 1 else float(values[i])
+        return record
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory records of a flight.
+
+LPCFlightData keeps the records of a flight as they come off the instrument:
+Time as int64, the 14 other HK words as raw uint16 with the divisor and offset
+that scale them (LPC_HK_DIVISOR and LPC_HK_OFFSET in readLPCXML) and the 32
+bins as uint16, 100 bytes a record instead of the 376 of the 47 float64 csv
+columns.  Scaled values are only computed when they are asked for, a column or
+a block of rows at a time, and are identical to the csv values.  The file each
+record came from is kept as a list of sources, like the chunks of a columnar
+store.
+
+  from LPC_FlightData import LPCFlightData
+  flight = LPCFlightData.from_tm_files(sorted(glob.glob('TM/ST2_C0_03_TTL3/*.gz')))
+  flight = LPCFlightData.from_master('LPC/ST2_C0_03_TTL3_LPC_Master.csv')
+  flow = flight['Flow']                              #float64, scaled on request
+  flight.export(master_file_name = 'Master.csv', mean_file_name = 'Mean.csv')
+  flight.save('LPC/ST2_C0_03_TTL3_LPC_Flight')       #raw arrays, loads back memory-mapped
+
+Anything that takes a dict of master columns (LPC_Resample.resample,
+LPC_Timeline.build_pyramid) or an LPCDataset (LPC_QuickPlot.quick_plot) also
+takes an LPCFlightData, the sinks of LPC_Stream (master, mean and columnar
+files) take its batches() and LPC_Plots.plot_flight_data draws the quick look
+plots of each source from it.
+"""
+
+import os
+import sys
+import json
+import numpy as np
+from readLPCXML import *
+from LPC_Columnar import load_store, read_store_index
+from LPC_Stream import MasterCSVSink, MeanSink, ColumnarSink, run_sinks
+from LPC_Make_Master_CSVs import MST_TO_UTC
+
+HK_NAMES = LPC_HK_FIELDS[1:]  #the raw HK columns, words 2 to 15 of a record
+N_BINS = 32
+BLOCK_ROWS = 1 << 16  #rows scaled at a time by batches() and the exports
+
+
+class LPCFlightData:
+    """
+    Raw Time, HK and bin arrays of a flight with lazily scaled views.  sources is
+    a list of {'source', 'start', 'rows'} giving the file each block of rows came from.
+    """
+    def __init__(self, time, hk, bins, sources = None, hk_divisor = LPC_HK_DIVISOR, hk_offset = LPC_HK_OFFSET):
+        self.time = np.asarray(time, dtype = np.int64)
+        self.hk = np.asarray(hk, dtype = np.uint16).reshape(len(self.time), len(HK_NAMES))
+        self.bins = np.asarray(bins, dtype = np.uint16).reshape(len(self.time), N_BINS)
+        if sources is None:
+            sources = [{'source': '', 'start': 0, 'rows': len(self.time)}]
+        self.sources = sources
+        self.hk_divisor = list(hk_divisor)
+        self.hk_offset = list(hk_offset)
+
+    @classmethod
+    def from_records(cls, records, source = ''):
+        """
+        From a record array returned by decodeLPCrecords (or readTM(...)['records'])
+        """
+        HKRaw = records['HK'].astype(np.int64)
+        time = HKRaw[:,0] + HKRaw[:,1]*65535
+        bins = np.concatenate((records['HG'], records['LG']), axis = 1)
+        return cls(time, HKRaw[:,2:], bins, [{'source': source, 'start': 0, 'rows': len(records)}])
+
+    @classmethod
+    def from_rows(cls, rows, source = ''):
+        """
+        From float rows with the 47 master csv columns, which must be unmodified
+        instrument values (not e.g. means)
+        """
+        rows = np.asarray(rows, dtype = np.float64).reshape(-1, 1 + len(HK_NAMES) + N_BINS)
+        raw = np.rint((rows[:,1:15] - np.array(LPC_HK_OFFSET)) * np.array(LPC_HK_DIVISOR))
+        bins = rows[:,15:]
+        if not (np.all(np.isfinite(rows)) and np.all((raw >= 0) & (raw <= 65535)) and np.all((bins >= 0) & (bins <= 65535))):
+            raise ValueError('Rows are not raw LPC records')
+        return cls(rows[:,0], raw, bins, [{'source': source, 'start': 0, 'rows': len(rows)}])
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        One LPCFlightData from a list of them, keeping their sources
+        """
+        sources = []
+        start = 0
+        for part in parts:
+            for s in part.sources:
+                sources.append(dict(s, start = s['start'] + start))
+            start += len(part)
+        if len(parts) == 0:
+            return cls(np.zeros(0), np.zeros((0, len(HK_NAMES))), np.zeros((0, N_BINS)), [])
+        return cls(np.concatenate([part.time for part in parts]), np.concatenate([part.hk for part in parts]),
+                   np.concatenate([part.bins for part in parts]), sources)
+
+    @classmethod
+    def from_tm_files(cls, tm_files, skip = 3, cache = None):
+        """
+        Decode TM files, dropping the first skip records of each as the master file
+        does.  With a RecordCache the files are read through it.
+        """
+        parts = []
+        for tm_file in tm_files:
+            TM = cache.read_tm(tm_file) if cache is not None else readTM(tm_file)
+            records = TM['records'][skip:]
+            if len(records) > 0:
+                parts.append(cls.from_records(records, tm_file))
+        return cls.concatenate(parts)
+
+    @classmethod
+    def from_master(cls, master_file_name):
+        """
+        From a master csv file or its columnar store (read through LPCDataset), one
+        source per chunk of the store
+        """
+        from LPC_Dataset import LPCDataset
+        store_dir = LPCDataset(master_file_name).store_dir
+        index = read_store_index(store_dir)
+        columns = load_store(store_dir)
+        parts = []
+        for chunk in index['chunks']:
+            for start in range(chunk['start'], chunk['start'] + chunk['rows'], BLOCK_ROWS):
+                stop = min(start + BLOCK_ROWS, chunk['start'] + chunk['rows'])
+                rows = np.column_stack([columns[name][start:stop] for name in LPC_HK_FIELDS] + [columns['Bins'][start:stop]])
+                parts.append(cls.from_rows(rows, chunk['source']))
+        flight = cls.concatenate(parts)
+        flight.sources = [{'source': chunk['source'], 'start': chunk['start'], 'rows': chunk['rows']} for chunk in index['chunks']]
+        return flight
+
+    def __len__(self):
+        return len(self.time)
+
+    @property
+    def nbytes(self):
+        return self.time.nbytes + self.hk.nbytes + self.bins.nbytes
+
+    def column(self, name, rows = slice(None)):
+        """
+        One column, scaled as in the csv files: 'Time' (int64), an HK field (the
+        currents as integers, the rest float64) or 'Bins' (the raw uint16 counts)
+        """
+        if name == 'Time':
+            return self.time[rows]
+        if name == 'Bins':
+            return self.bins[rows]
+        k = HK_NAMES.index(name)
+        raw = self.hk[rows, k].astype(np.int64)
+        if self.hk_divisor[k] == 1 and self.hk_offset[k] == 0:
+            return raw
+        if self.hk_offset[k] == 0:
+            return raw / self.hk_divisor[k]
+        return raw / self.hk_divisor[k] + self.hk_offset[k]
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def __contains__(self, name):
+        return name in ('Time', 'Bins') or name in HK_NAMES
+
+    def scan(self, i):
+        """
+        Return one record as a dict of HK values (floats) and 'Bins' (32 values)
+        """
+        record = dict((name, float(self.column(name, slice(i, i+1))[0])) for name in LPC_HK_FIELDS)
+        record['Bins'] = self.bins[i].astype(np.float64)
+        return record
+
+    def rows(self, start = 0, stop = None):
+        """
+        Float rows with the 47 csv columns, the same as LPCrecordArray
+        """
+        rows = slice(start, len(self) if stop is None else stop)
+        return np.column_stack([self.column(name, rows) for name in LPC_HK_FIELDS] + [self.bins[rows]]).astype(np.float64)
+
+    def batches(self, block_rows = BLOCK_ROWS):
+        """
+        Yield (source, float rows) for every source in order, at most block_rows at a
+        time, as the sinks of LPC_Stream and MeanAccumulator take them
+        """
+        for s in self.sources:
+            for start in range(s['start'], s['start'] + s['rows'], block_rows):
+                yield s['source'], self.rows(start, min(start + block_rows, s['start'] + s['rows']))
+
+    def export(self, master_file_name = None, mean_file_name = None, store_dir = None, stats_file_name = None,
+               time_offset = MST_TO_UTC):
+        """
+        Write any of the master csv file, mean csv file (plus statistics file) and
+        columnar master store, in the same format master_csv writes them
+        """
+        sinks = []
+        if master_file_name is not None:
+            sinks.append(MasterCSVSink(master_file_name))
+        if mean_file_name is not None:
+            sinks.append(MeanSink(mean_file_name, stats_file_name, time_offset))
+        if store_dir is not None:
+            sinks.append(ColumnarSink(store_dir))
+        return run_sinks(self.batches(), sinks)
+
+    def save(self, directory):
+        """
+        Write the raw arrays (time.i8, hk.u2, bins.u2, little-endian) and an index.json
+        with the sources and the HK scaling to directory
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.time.astype('<i8').tofile(os.path.join(directory, 'time.i8'))
+        self.hk.astype('<u2').tofile(os.path.join(directory, 'hk.u2'))
+        self.bins.astype('<u2').tofile(os.path.join(directory, 'bins.u2'))
+        index = {'rows': len(self), 'hk_columns': HK_NAMES, 'hk_divisor': self.hk_divisor, 'hk_offset': self.hk_offset,
+                 'sources': self.sources}
+        tmp = os.path.join(directory, 'index.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent = 1)
+        os.replace(tmp, os.path.join(directory, 'index.json'))
+
+    @classmethod
+    def load(cls, directory, mmap = True):
+        """
+        Load what save wrote, by default as read-only memory maps
+        """
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            index = json.load(f)
+        n = index['rows']
+        def read(name, dtype, width):
+            shape = (n,) if width == 1 else (n, width)
+            if n == 0:
+                return np.zeros(shape, dtype = dtype)
+            if mmap:
+                return np.memmap(os.path.join(directory, name), dtype = dtype, mode = 'r', shape = shape)
+            return np.fromfile(os.path.join(directory, name), dtype = dtype, count = n * width).reshape(shape)
+        flight = cls.__new__(cls)
+        flight.time = read('time.i8', '<i8', 1)
+        flight.hk = read('hk.u2', '<u2', len(index['hk_columns']))
+        flight.bins = read('bins.u2', '<u2', N_BINS)
+        flight.sources = index['sources']
+        flight.hk_divisor = index['hk_divisor']
+        flight.hk_offset = index['hk_offset']
+        return flight
+
+def main():
+    if len(sys.argv) < 3:
+        print('Usage: python3 LPC_FlightData.py master_csv|TM_file ... output_dir')
+        return
+    inputs = sys.argv[1:-1]
+    if len(inputs) == 1 and not inputs[0].endswith('.gz'):
+        flight = LPCFlightData.from_master(inputs[0])
+    else:
+        flight = LPCFlightData.from_tm_files(inputs)
+    flight.save(sys.argv[-1])
+    print('Wrote ' + str(len(flight)) + ' records (' + '{:.1f}'.format(flight.nbytes / 1e6) + ' MB) to ' + sys.argv[-1])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-flight index of the TM file headers.
+
+An SQLite database (e.g. LPC/ST2_C0_03_TTL3_LPC_Headers.sqlite) with one row per
+TM file holding its typed header record (see readLPCXML.headerRecord): message
+ID (the text of <Msg>, with its leading zeros), instrument, length, the three state flags and messages, CRC, the start time
+from the binary header, the time of the first and last good record, the number
+of records and the framing, plus any other header tags as JSON.  GetLPC fills
+it as files are converted, so the state of the instrument over a flight can be
+searched without opening any TM file again:
+
+  from LPC_HeaderIndex import HeaderIndex
+  with HeaderIndex('LPC/ST2_C0_03_TTL3_LPC_Headers.sqlite') as index:
+      rows = index.search(state_flag = 'WARN')
+      rows = index.search(message = '%Heater%', t_start = t0, t_end = t1)
+
+"python3 LPC_HeaderIndex.py index.sqlite [message pattern]" prints the state
+messages as the old LPC_Log.txt did, and "python3 LPC_HeaderIndex.py
+index.sqlite --add TM_dir" indexes TM files that were converted before the
+index existed, reading only their headers.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import sqlite3
+from readLPCXML import readTMHeader, LPC_HEADER_SCHEMA
+
+#(header record key, column, SQL type) of the typed columns
+COLUMNS = [(tag, tag if tag != 'Msg' else 'MsgID', 'INTEGER' if kind is int else 'TEXT') for tag, kind in LPC_HEADER_SCHEMA]
+COLUMNS += [('StartTime', 'StartTime', 'INTEGER'), ('FirstTime', 'FirstTime', 'INTEGER'),
+            ('LastTime', 'LastTime', 'INTEGER'), ('Records', 'Records', 'INTEGER'), ('Framing', 'Framing', 'TEXT')]
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS headers (\n    filename TEXT PRIMARY KEY,\n' +
+          ''.join('    ' + column + ' ' + kind + ',\n' for key, column, kind in COLUMNS) +
+          '    Extra TEXT,\n    updated REAL\n)')
+#indexes made before the message ID was kept as text have an INTEGER MsgID column
+MIGRATE_MSGID = ['ALTER TABLE headers RENAME TO headers_old', SCHEMA,
+                 'INSERT INTO headers SELECT * FROM headers_old', 'DROP TABLE headers_old']
+INDEXES = ['CREATE INDEX IF NOT EXISTS headers_time ON headers (StartTime)',
+           'CREATE INDEX IF NOT EXISTS headers_msg ON headers (MsgID)']
+
+
+def tm_header_record(TM):
+    """
+    Header record of a TM dict from readTM (or the RecordCache) with the times of its
+    first and last good record, the number of records and the framing
+    """
+    record = dict(TM['header'])
+    times = TM['HK'][0] if TM.get('HK') is not None else None
+    if len(TM['records']) > 0:
+        if times is None:
+            HK = TM['records']['HK']
+            times = HK[:,0].astype(int) + HK[:,1].astype(int)*65535
+        record['FirstTime'] = int(times[0])
+        record['LastTime'] = int(times[-1])
+    record['Records'] = len(TM['records'])
+    record['Framing'] = TM['quality']['framing']
+    return record
+
+def log_line(row):
+    """
+    State message line of an index row, in the format of the old LPC_Log.txt
+    """
+    return row['filename'] + ': ' + str(row['MsgID']) + ' ' + str(row['StateMess1']) + '\n'
+
+class HeaderIndex:
+    """
+    Header records of the TM files of one flight, stored in db_file
+    """
+    def __init__(self, db_file):
+        folder = os.path.dirname(db_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(db_file)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute(SCHEMA)
+        if dict((row['name'], row['type']) for row in self.db.execute('PRAGMA table_info(headers)'))['MsgID'] == 'INTEGER':
+            for statement in MIGRATE_MSGID:  #their leading zeros are lost, "--add TM_dir" reads them again
+                self.db.execute(statement)
+        for index in INDEXES:
+            self.db.execute(index)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, records):
+        """
+        Add or replace the header records of a list of (filename, record) tuples
+        """
+        names = ['filename'] + [column for key, column, kind in COLUMNS] + ['Extra', 'updated']
+        rows = [[filename] + [record.get(key) for key, column, kind in COLUMNS] +
+                [json.dumps(record.get('Extra') or {}), time.time()]
+                for filename, record in records]
+        for row in rows:
+            row[0] = os.path.basename(row[0])
+        self.db.executemany('INSERT OR REPLACE INTO headers (' + ', '.join(names) + ') VALUES (' +
+                            ', '.join(['?'] * len(names)) + ')', rows)
+        self.db.commit()
+
+    def add_files(self, tm_files):
+        """
+        Index TM files by reading only their headers, returns the number indexed
+        """
+        records = [(f, readTMHeader(f)) for f in tm_files]
+        self.put(records)
+        return len(records)
+
+    def search(self, message = None, state_flag = None, msg_id = None, t_start = None, t_end = None):
+        """
+        Rows (as dicts, in start time order) whose state messages match the SQL LIKE
+        pattern message, whose state flags equal state_flag, with message ID msg_id
+        (compared as a number, so 7 matches <Msg>007</Msg>) and/or a start time
+        between t_start and t_end
+        """
+        where = []
+        values = []
+        if message is not None:
+            where.append('(StateMess1 LIKE ? OR StateMess2 LIKE ? OR StateMess3 LIKE ?)')
+            values += [message] * 3
+        if state_flag is not None:
+            where.append('(StateFlag1 = ? OR StateFlag2 = ? OR StateFlag3 = ?)')
+            values += [state_flag] * 3
+        if msg_id is not None:
+            where.append('CAST(MsgID AS INTEGER) = ?')
+            values.append(int(msg_id))
+        if t_start is not None:
+            where.append('StartTime >= ?')
+            values.append(t_start)
+        if t_end is not None:
+            where.append('StartTime <= ?')
+            values.append(t_end)
+        cursor = self.db.execute('SELECT * FROM headers' + (' WHERE ' + ' AND '.join(where) if where else '') +
+                                 ' ORDER BY StartTime, filename', values)
+        return [dict(row) for row in cursor]
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM headers').fetchone()[0]
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 LPC_HeaderIndex.py index.sqlite [message pattern | --add TM_dir]')
+        return
+    with HeaderIndex(sys.argv[1]) as index:
+        if len(sys.argv) > 3 and sys.argv[2] == '--add':
+            print('Indexed ' + str(index.add_files(sorted(glob.glob(os.path.join(sys.argv[3], '*.gz'))))) + ' files')
+            return
+        for row in index.search(message = sys.argv[2] if len(sys.argv) > 2 else None):
+            sys.stdout.write(log_line(row))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timers and counters for the LPC processing chain.
+
+Every stage of the chain (sftp, gzip, decode, csv_write, master_read,
+master_write, plot, ...) is timed into the process wide StageMetrics
+'metrics', and counters keep track of the files, bytes and records that go
+through them:
+
+  from LPC_Instrument import metrics
+  with metrics.stage('decode'):
+      records = decodeLPCrecords(data)
+  metrics.count('records', len(records))
+
+Worker processes start from reset_metrics() and hand what they recorded back
+to the parent with take() and merge().  GetLPC writes metrics.summary() to a
+JSON file at the end of each run.  profiled() optionally runs a block under
+cProfile or tracemalloc.
+"""
+
+import os
+import json
+import time
+import cProfile
+import pstats
+import threading
+import tracemalloc
+import contextlib
+
+
+class StageMetrics:
+    """
+    Thread safe count, total, last and maximum duration of each processing stage,
+    and named counters
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = dict()
+        self.counters = dict()
+        self.started = time.time()
+
+    def record(self, name, seconds, count = 1):
+        with self.lock:
+            s = self.stages.setdefault(name, {'count': 0, 'total_s': 0.0, 'last_s': 0.0, 'max_s': 0.0})
+            s['count'] += count
+            s['total_s'] += seconds
+            s['last_s'] = seconds
+            s['max_s'] = max(s['max_s'], seconds)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time the body of a with statement as one run of a stage
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_latency(self, files, name = 'end_to_end'):
+        """
+        Record the time since each file was last modified, for downloaded files that
+        is the time it was written on the CCMz
+        """
+        now = time.time()
+        for f in files:
+            if os.path.exists(f):
+                self.record(name, now - os.path.getmtime(f))
+
+    def take(self):
+        """
+        Return everything recorded so far as a plain dict and start again from zero,
+        used to send what a worker process recorded back to the parent
+        """
+        with self.lock:
+            taken = {'stages': self.stages, 'counters': self.counters}
+            self.stages = dict()
+            self.counters = dict()
+        return taken
+
+    def merge(self, taken):
+        """
+        Add the stages and counters returned by take() in another process
+        """
+        with self.lock:
+            for name, s in taken['stages'].items():
+                mine = self.stages.setdefault(name, {'count': 0, 'total_s': 0.0, 'last_s': 0.0, 'max_s': 0.0})
+                mine['count'] += s['count']
+                mine['total_s'] += s['total_s']
+                mine['last_s'] = s['last_s']
+                mine['max_s'] = max(mine['max_s'], s['max_s'])
+            for name, n in taken['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        self.take()
+        self.started = time.time()
+
+    def summary(self):
+        with self.lock:
+            stages = dict()
+            for name, s in self.stages.items():
+                stages[name] = dict(s, mean_s = s['total_s'] / max(s['count'], 1))
+            counters = dict(self.counters)
+        return {'updated': time.time(), 'uptime_s': time.time() - self.started, 'stages': stages, 'counters': counters}
+
+    def write(self, filename, extra = None):
+        """
+        Save the summary (plus the items of the dict extra) as JSON, replacing the file
+        in one step so readers never see half of it
+        """
+        summary = self.summary()
+        if extra is not None:
+            summary.update(extra)
+        directory = os.path.dirname(filename)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(summary, f, indent = 1)
+        os.replace(filename + '.tmp', filename)
+
+    def report(self):
+        """
+        One line with the mean duration of each stage
+        """
+        return ', '.join(name + ' ' + '{:.3g}'.format(s['mean_s']) + ' s' for name, s in sorted(self.summary()['stages'].items()))
+
+metrics = StageMetrics()
+
+def reset_metrics():
+    """
+    Clear the metrics, used as the initializer of worker processes so a forked
+    worker does not send back what the parent had already recorded
+    """
+    metrics.reset()
+
+@contextlib.contextmanager
+def profiled(mode, output_file):
+    """
+    Run the body of a with statement under cProfile (mode 'cprofile', the stats are
+    saved to output_file for pstats or snakeviz plus a text report output_file.txt)
+    or tracemalloc (mode 'tracemalloc', the 25 lines that allocated most and the
+    peak are saved to output_file.txt).  Any other mode, e.g. None, does nothing.
+    """
+    if mode not in ('cprofile', 'tracemalloc'):
+        yield
+        return
+    directory = os.path.dirname(output_file)
+    if directory != '' and not os.path.exists(directory):
+        os.makedirs(directory)
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(output_file)
+            with open(output_file + '.txt', 'w') as f:
+                pstats.Stats(profile, stream = f).sort_stats('cumulative').print_stats(40)
+    else:
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            metrics.count('peak_traced_bytes', peak)
+            with open(output_file + '.txt', 'w') as f:
+                f.write('Peak traced memory: ' + '{:.1f}'.format(peak / 1e6) + ' MB\n')
+                for stat in snapshot.statistics('lineno')[:25]:
+                    f.write(str(stat) + '\n')
@@ -10,54 +10,296 @@ an average of all the contents of the individual files
 
 import os
 import glob
+import json
+import itertools
+import logging
+import warnings
 import numpy as np
 import csv
+from LPC_Columnar import *
+from LPC_Instrument import metrics
+from LPC_SizeDist import size_distribution, N_BINS
 
-def read_lpc_csv(filename, meanoutfile, masteroutfile):
-    """ 
-    This function reads the individual csv files generates from each LPC TM,
-    then sorts through the data and pulls out any records where the flow is 
-    greater than 1 SLPM, averages the values for those records, and saves them 
-    to the mean csv file.
+log = logging.getLogger(__name__)
+
+MST_TO_UTC = 25200 #default offset added to the mean time, adjusts from MST to UTC
+STATS_NAMES = ['mean', 'std', 'min', 'max']
+STATS_VERSION = 2 #columns of the statistics file, a different version in the manifest forces a rebuild
+
+class MeanAccumulator:
     """
-    #read the source csv file and ditch the header and first 3 measurements    
-    data = np.genfromtxt(filename, delimiter = ',', skip_header = 6)  
-    
-    #save all the data to the master file
-    f = open(masteroutfile,'ab')
-    np.savetxt(f,data, delimiter=",")
-    f.close
+    Running statistics of the records of one TM file that have a flow of at least
+    0.5 SLPM, with values below -273 treated as missing.  Keeps sums, counts, 
+    min/max and the sum of squared deviations per column, so the records can be
+    added a block at a time.  The positive steps between record times are kept
+    for the sample time of the size distribution.
+    """
+    def __init__(self, n_columns = 47):
+        self.sums = np.zeros(n_columns)
+        self.counts = np.zeros(n_columns, dtype = np.int64)
+        self.m2 = np.zeros(n_columns)
+        self.mins = np.full(n_columns, np.inf)
+        self.maxs = np.full(n_columns, -np.inf)
+        self.n_records = 0
+        self.n_nans = 0
+        self.n_good = 0
+        self.time_steps = []
+        self.last_time = None
+
+    def add(self, batch):
+        if len(batch) > 0:
+            steps = np.diff(batch[:,0]) if self.last_time is None else np.diff(np.r_[self.last_time, batch[:,0]])
+            self.time_steps.append(steps[steps > 0])
+            self.last_time = batch[-1,0]
+        batch = np.where(batch < -273.0, np.nan, batch)
+        missing = np.isnan(batch)
+        self.n_records += len(batch)
+        self.n_nans += np.count_nonzero(missing)
+        good = ~(batch[:,8] < 0.5)
+        self.n_good += np.count_nonzero(good)
+        present = ~missing[good]
+        values = np.where(present, batch[good], 0.0)
+        n_b = present.sum(axis = 0)
+        sum_b = values.sum(axis = 0)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            #combine the squared deviations of this block with the running ones (Chan et al.)
+            mean_a = self.sums / self.counts
+            mean_b = sum_b / n_b
+            m2_b = (np.where(present, values - mean_b, 0.0)**2).sum(axis = 0)
+            n = self.counts + n_b
+            both = (self.counts > 0) & (n_b > 0)
+            self.m2 += m2_b + np.where(both, (mean_b - mean_a)**2 * self.counts * n_b / np.maximum(n, 1), 0.0)
+        self.mins = np.minimum(self.mins, np.where(present, values, np.inf).min(axis = 0, initial = np.inf))
+        self.maxs = np.maximum(self.maxs, np.where(present, values, -np.inf).max(axis = 0, initial = -np.inf))
+        self.sums += sum_b
+        self.counts += n_b
+
+    def mean(self):
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return self.sums / self.counts
+
+    def std(self):
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            return np.sqrt(self.m2 / self.counts)
+
+    def minimum(self):
+        return np.where(self.counts > 0, self.mins, np.nan)
+
+    def maximum(self):
+        return np.where(self.counts > 0, self.maxs, np.nan)
+
+    def size_distribution(self):
+        """
+        Size distribution of the good records taken as one sample: their summed counts
+        over the volume they sampled, with the median step between records as the
+        sample time (see LPC_SizeDist).  NaN if there are no good records or only one time.
+        """
+        steps = np.concatenate(self.time_steps) if len(self.time_steps) > 0 else np.zeros(0)
+        dt = float(np.median(steps)) if len(steps) > 0 else np.nan
+        return size_distribution(self.sums[15:15+N_BINS], self.sums[8], dt = dt)
+
+def stats_header(names):
+    """
+    Header line of the statistics file for columns called names (15 HK fields then
+    the bin diameters): the statistics of every column, the record counts and the
+    sample volume, total concentration, concentration and dN/dlogD of the good records
+    """
+    diams = names[15:15+N_BINS]
+    return (['File'] + [name + '_' + stat for name in names for stat in STATS_NAMES] + ['N_Records', 'N_Good', 'N_NaNs'] +
+            ['Volume', 'Total_Conc'] + ['Conc_' + d for d in diams] + ['dNdlogD_' + d for d in diams])
+
+def write_mean(accumulator, filename, meanoutfile, mean_store = None, statsoutfile = None, time_offset = MST_TO_UTC):
+    """
+    Write the mean of one TM file to the mean file (and the StoreWriter mean_store)
+    if it has more than 3 good records, and a line of statistics (with the size
+    distribution of the good records) to the statistics file if given.
+    """
+    log.debug('good_records=%d file=%s', accumulator.n_good, filename)
     
-    #only save the mean data with flow above 0.5 slpm to the mean file
-    data[data < -273.0] = np.nan
-    number_of_nans = np.count_nonzero(np.isnan(data))
-    flow = data[:,8]
-    to_delete = np.where(flow < 0.5)
-    data = np.delete(data,to_delete[0],0)   
-    print(str(len(flow) - len(to_delete[0])) + " Good records in file: " + filename )  
+    if statsoutfile is not None:
+        stats = np.column_stack((accumulator.mean(), accumulator.std(), accumulator.minimum(), accumulator.maximum()))
+        stats[0,[0,2,3]] += time_offset
+        szd = accumulator.size_distribution()
+        with open(statsoutfile, 'a', newline = '') as csvfile:
+            writer = csv.writer(csvfile, delimiter=',')
+            writer.writerow([filename] + stats.ravel().tolist() + [accumulator.n_records, accumulator.n_good, accumulator.n_nans] +
+                            [szd['volume'][0], szd['total'][0]] + szd['conc'][0].tolist() + szd['dNdlogD'][0].tolist())
     
-    if (len(flow) - len(to_delete[0])) > 3:
-        mean_data = np.nanmean(data,axis = 0)
-        mean_data[0] = mean_data[0] + 25200 #adjust from MST to UTC
-        mean_data_nans = np.append(mean_data,number_of_nans)
+    if accumulator.n_good > 3:
+        mean_data = accumulator.mean()
+        mean_data[0] = mean_data[0] + time_offset
+        mean_data_nans = np.append(mean_data,accumulator.n_nans)
         
         with open(meanoutfile, 'a', newline = '') as csvfile:
             writer = csv.writer(csvfile, delimiter=',')
             writer.writerow(mean_data_nans)
-       
+        if mean_store is not None:
+            mean_store.append(filename, mean_data_nans)
+
+def read_lpc_csv(filename, meanoutfile, masteroutfile, master_store = None, mean_store = None,
+                 statsoutfile = None, time_offset = MST_TO_UTC, block_rows = 10000):
+    """ 
+    This function reads the individual csv files generates from each LPC TM,
+    then sorts through the data and pulls out any records where the flow is 
+    greater than 1 SLPM, averages the values for those records, and saves them 
+    to the mean csv file.  Returns the number of records in the file.
+    If master_store and mean_store (StoreWriters, see LPC_Columnar) are given, the
+    records and the mean are also appended to those columnar stores.
+    The file is read block_rows lines at a time and the mean is accumulated as it
+    goes, statsoutfile optionally gets the mean, std, min and max of each column.
+    time_offset is added to the mean time.
+    """
+    accumulator = None
+    n_records = 0
+    with open(filename, 'r') as csvfile, open(masteroutfile,'ab') as f:
+        #ditch the header and first 3 measurements    
+        for line in itertools.islice(csvfile, 6):
+            pass
+        while True:
+            with metrics.stage('master_read'):
+                lines = list(itertools.islice(csvfile, block_rows))
+                if len(lines) == 0:
+                    break
+                data = np.loadtxt(lines, delimiter = ',', ndmin = 2)
+            n_records += len(data)
+            
+            #save all the data to the master file
+            with metrics.stage('master_write'):
+                np.savetxt(f,data, delimiter=",")
+                if master_store is not None:
+                    master_store.append(filename, data, extend = True)
+            
+            #only use the data with flow above 0.5 slpm for the mean 
+            with metrics.stage('mean'):
+                if accumulator is None:
+                    accumulator = MeanAccumulator(data.shape[1])
+                accumulator.add(data)
+    
+    if accumulator is not None:
+        with metrics.stage('mean'):
+            write_mean(accumulator, filename, meanoutfile, mean_store, statsoutfile, time_offset)
+    metrics.count('master_files')
+    metrics.count('master_records', n_records)
+    
+    return n_records
+
+def manifest_file_name(master_file_name):
+    """
+    Name of the manifest that records which csv files are in the master file
+    """
+    return os.path.splitext(master_file_name)[0] + '_manifest.json'
+
+def csv_file_entry(filename):
+    """
+    Manifest entry identifying one csv file by name, size and modification time
+    """
+    st = os.stat(filename)
+    return {'filename': filename, 'size': st.st_size, 'mtime': st.st_mtime}
 
+def read_manifest(mean_file_name, master_file_name, columnar = False, stats_file_name = None, time_offset = MST_TO_UTC):
+    """
+    Read the manifest for a master/mean file pair.  Returns None if there is no 
+    manifest, if the master, mean or statistics file (or the columnar stores) no
+    longer match it, or if it was written with a different time offset.
+    """
+    try:
+        with open(manifest_file_name(master_file_name), 'r') as f:
+            manifest = json.load(f)
+        if (manifest['mean_file'] != mean_file_name or 
+            os.path.getsize(master_file_name) != manifest['master_size'] or
+            os.path.getsize(mean_file_name) != manifest['mean_size'] or
+            manifest.get('time_offset', MST_TO_UTC) != time_offset or
+            manifest.get('stats_file') != stats_file_name):
+            return None
+        if stats_file_name is not None and (os.path.getsize(stats_file_name) != manifest['stats_size'] or
+                                            manifest.get('stats_version') != STATS_VERSION):
+            return None
+        if columnar and (
+            read_store_index(columnar_store_name(master_file_name))['rows'] != manifest.get('master_store_rows') or
+            read_store_index(columnar_store_name(mean_file_name))['rows'] != manifest.get('mean_store_rows')):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest
+
+def write_manifest(manifest, mean_file_name, master_file_name, columnar = False, stats_file_name = None, time_offset = MST_TO_UTC):
+    """
+    Save the manifest along with the current size of the master and mean files
+    """
+    manifest['mean_file'] = mean_file_name
+    manifest['master_size'] = os.path.getsize(master_file_name)
+    manifest['mean_size'] = os.path.getsize(mean_file_name)
+    manifest['time_offset'] = time_offset
+    manifest['stats_file'] = stats_file_name
+    if stats_file_name is not None:
+        manifest['stats_size'] = os.path.getsize(stats_file_name)
+        manifest['stats_version'] = STATS_VERSION
+    if columnar:
+        manifest['master_store_rows'] = read_store_index(columnar_store_name(master_file_name))['rows']
+        manifest['mean_store_rows'] = read_store_index(columnar_store_name(mean_file_name))['rows']
+    with open(manifest_file_name(master_file_name), 'w') as f:
+        json.dump(manifest, f, indent = 1)
 
+def append_csv_files(entries, manifest, mean_file_name, master_file_name, columnar = False, stats_file_name = None, time_offset = MST_TO_UTC):
+    """
+    Append the records and means from each csv file in entries to the master and
+    mean files, recording where each file starts in the manifest
+    """
+    master_store = StoreWriter(columnar_store_name(master_file_name)) if columnar else None
+    mean_store = StoreWriter(columnar_store_name(mean_file_name)) if columnar else None
+    try:
+        for entry in entries:
+            entry['master_offset'] = os.path.getsize(master_file_name)
+            entry['mean_offset'] = os.path.getsize(mean_file_name)
+            entry['rows'] = read_lpc_csv(entry['filename'], mean_file_name,master_file_name, master_store, mean_store,
+                                         stats_file_name, time_offset)
+            manifest['files'].append(entry)
+    finally:
+        if columnar:
+            master_store.close()
+            mean_store.close()
+    write_manifest(manifest, mean_file_name, master_file_name, columnar, stats_file_name, time_offset)
 
-def master_csv(csv_dir,mean_file_name,master_file_name):
+def master_csv(csv_dir,mean_file_name,master_file_name, incremental = False, columnar = False,
+               stats_file_name = None, time_offset = MST_TO_UTC):
     """
     This function reads all the individual TM file names in the 'csv_dir'
     directory, creates new mean and master csv files, then processes 
-    all the individual files into these mean and master files
+    all the individual files into these mean and master files.
+    
+    With incremental = True only csv files that are newer than the ones already
+    in the master file are appended.  If any file that is already in the master
+    file changed or was removed, or a new file sorts before the last one processed,
+    the master and mean files are rebuilt from scratch.
+    
+    With columnar = True the master and mean data are also written to columnar
+    stores next to the csv files (see LPC_Columnar), which load without any text 
+    parsing.  The csv files can be regenerated from the stores with export_master_csv
+    and export_mean_csv.
+    
+    stats_file_name optionally names a file that gets the mean, std, min and max
+    of every column of each TM file (see read_lpc_csv).  time_offset is added to
+    the mean times, by default the MST to UTC offset.
     """ 
     #read all the file names in the csv dir
     filenames = glob.glob(csv_dir)
     filenames.sort() #sort the list based on filename
-    print("Mean File Name: " + mean_file_name)
+    log.info('mean_file=%s', mean_file_name)
+    
+    if incremental and len(filenames)>1:
+        manifest = read_manifest(mean_file_name, master_file_name, columnar, stats_file_name, time_offset)
+        if manifest is not None:
+            entries = [csv_file_entry(filename) for filename in filenames if os.stat(filename).st_size > 0]
+            done = manifest['files']
+            keys = ('filename', 'size', 'mtime')
+            if len(done) <= len(entries) and all(
+                    [old[k] for k in keys] == [new[k] for k in keys] for old, new in zip(done, entries)):
+                log.info('new_files=%d master_file=%s', len(entries) - len(done), master_file_name)
+                append_csv_files(entries[len(done):], manifest, mean_file_name, master_file_name, columnar,
+                                 stats_file_name, time_offset)
+                return
+            log.info('processed files changed, rebuilding master_file=%s', master_file_name)
+    
     #read the header from one of the csv files
     if len(filenames)>1:
         with open(filenames[1], 'r', newline = '') as csvfile:
@@ -75,13 +317,67 @@ def master_csv(csv_dir,mean_file_name,master_file_name):
             outfile.write(second)
             outfile.write(third)
         
+        if stats_file_name is not None:
+            with open(stats_file_name, 'w', newline = '') as outfile:
+                writer = csv.writer(outfile, delimiter=',')
+                writer.writerow(stats_header(next(csv.reader([second]))))
+        
+        if columnar:
+            create_store(columnar_store_name(master_file_name), MASTER_COLUMNS, second + third)
+            create_store(columnar_store_name(mean_file_name), MEAN_COLUMNS, second + third)
+        
         #loop over all the rest of the csv files
-        for filename in filenames:
-            if os.stat(filename).st_size > 0:  #only if it is not zero bytes
-                #print(filename)
-                read_lpc_csv(filename, mean_file_name,master_file_name)
+        entries = [csv_file_entry(filename) for filename in filenames if os.stat(filename).st_size > 0]  #only if it is not zero bytes
+        append_csv_files(entries, {'files': []}, mean_file_name, master_file_name, columnar, stats_file_name, time_offset)
     else:
-        print('No files t process')
+        log.info('no files to process')
+
+def combine_flights(flight_files, campaign_mean_file_name, campaign_summary_file_name):
+    """
+    Combine the mean files of several flights into one mean file with a Flight
+    column in front, and write a summary file with one line per flight: the
+    number of TM files, mean rows and records, the first and last mean time and
+    the average of every mean column.  flight_files is a list of
+    (flight, mean_file_name, master_file_name) tuples, flights without a mean 
+    file are skipped.
+    """
+    summary_rows = []
+    names = None
+    with open(campaign_mean_file_name, 'w', newline = '') as outfile:
+        for flight, mean_file_name, master_file_name in flight_files:
+            if not os.path.exists(mean_file_name):
+                log.warning('no mean file for flight=%s', flight)
+                continue
+            with open(mean_file_name, 'r', newline = '') as meanfile:
+                header = meanfile.readline()
+                units = meanfile.readline()
+                lines = meanfile.readlines()
+            if names is None:
+                names = next(csv.reader([header])) + ['NaNs']
+                outfile.write('Flight,' + header)
+                outfile.write(',' + units)
+            for line in lines:
+                outfile.write(flight + ',' + line)
+            
+            try:
+                with open(manifest_file_name(master_file_name), 'r') as f:
+                    files = json.load(f)['files']
+            except (OSError, ValueError, KeyError):
+                files = []
+            data = np.loadtxt(lines, delimiter = ',', ndmin = 2) if len(lines) > 0 else np.full((1, len(names)), np.nan)
+            with np.errstate(invalid = 'ignore'), warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)  #all NaN columns
+                means = np.nanmean(data, 0)
+            summary_rows.append([flight, len(files), len(lines), sum(entry.get('rows', 0) for entry in files),
+                                 np.nanmin(data[:,0]) if len(lines) > 0 else np.nan,
+                                 np.nanmax(data[:,0]) if len(lines) > 0 else np.nan] + means.tolist())
+    
+    with open(campaign_summary_file_name, 'w', newline = '') as outfile:
+        writer = csv.writer(outfile, delimiter=',')
+        writer.writerow(['Flight', 'N_TM_Files', 'N_Mean_Rows', 'N_Records', 'Start_Time', 'End_Time'] + 
+                        [name + '_mean' for name in (names or [])])
+        writer.writerows(summary_rows)
+    return len(summary_rows)
 
 def main():
     csv_dir = 'Processed/csv/*.csv'
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent download and processing manifest.
+
+An SQLite database with one row per TM file, keyed by flight and filename, that
+records the remote size and modification time, whether the file was downloaded,
+whether it was converted to csv, the number of records and the last error.
+GetLPC uses it to decide which remote files are new with a set lookup, and to
+reconvert only the files that failed ('python3 GetLPC.py retry-failed').
+"""
+
+import os
+import time
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    flight TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    local_path TEXT,
+    remote_size INTEGER,
+    remote_mtime REAL,
+    download_state TEXT,
+    parse_state TEXT,
+    rows INTEGER,
+    error TEXT,
+    updated REAL,
+    PRIMARY KEY (flight, filename)
+)
+"""
+
+
+class LPCManifest:
+    """
+    Download/processing state of every TM file, stored in db_file
+    """
+    def __init__(self, db_file):
+        folder = os.path.dirname(db_file)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.db = sqlite3.connect(db_file)
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _upsert(self, flight, filename, **fields):
+        fields['updated'] = time.time()
+        names = ', '.join(fields)
+        self.db.execute('INSERT INTO files (flight, filename, ' + names + ') VALUES (?, ?' + ', ?'*len(fields) + ') '
+                        'ON CONFLICT (flight, filename) DO UPDATE SET ' + ', '.join(n + ' = excluded.' + n for n in fields),
+                        [flight, filename] + list(fields.values()))
+        self.db.commit()
+
+    def downloaded_files(self, flight):
+        """
+        Set of the filenames of a flight that have been downloaded
+        """
+        cursor = self.db.execute("SELECT filename FROM files WHERE flight = ? AND download_state = 'done'", (flight,))
+        return set(row[0] for row in cursor)
+
+    def import_local_files(self, flight, local_folder):
+        """
+        Record the files already in local_folder as downloaded, used the first time
+        a flight that was mirrored without a manifest is seen
+        """
+        if not os.path.exists(local_folder):
+            return
+        for entry in os.scandir(local_folder):
+            if entry.is_file() and not entry.name.endswith('.part'):
+                st = entry.stat()
+                self._upsert(flight, entry.name, local_path = entry.path, remote_size = st.st_size,
+                             remote_mtime = st.st_mtime, download_state = 'done')
+
+    def mark_downloaded(self, flight, filename, local_path, size, mtime):
+        self._upsert(flight, filename, local_path = local_path, remote_size = size, remote_mtime = mtime,
+                     download_state = 'done', parse_state = None, rows = None, error = None)
+
+    def mark_download_failed(self, flight, filename, size, mtime, error):
+        self._upsert(flight, filename, remote_size = size, remote_mtime = mtime,
+                     download_state = 'failed', error = error)
+
+    def mark_parsed(self, flight, filename, rows):
+        self._upsert(flight, filename, parse_state = 'done', rows = rows, error = None)
+
+    def mark_parse_failed(self, flight, filename, error):
+        self._upsert(flight, filename, parse_state = 'failed', error = error)
+
+    def failed_files(self, flight):
+        """
+        Local paths of the downloaded files of a flight that could not be converted
+        """
+        cursor = self.db.execute("SELECT local_path FROM files WHERE flight = ? AND download_state = 'done' "
+                                 "AND parse_state = 'failed' ORDER BY filename", (flight,))
+        return [row[0] for row in cursor]
+
+    def summary(self, flight):
+        """
+        Number of files of a flight in each (download_state, parse_state)
+        """
+        cursor = self.db.execute('SELECT download_state, parse_state, COUNT(*) FROM files WHERE flight = ? '
+                                 'GROUP BY download_state, parse_state', (flight,))
+        return dict(((d, p), n) for d, p, n in cursor)
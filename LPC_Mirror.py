@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent mirroring of CCMz folders.
+
+Downloads run on a thread pool that shares a small pool of sessions, so one
+set of SFTP connections is reused for every flight folder and several files are
+in flight at once.  Each file is written to a .part file that is renamed into
+place only once it is complete; a .part file left by an interrupted run is
+resumed from where it stopped.
+
+Transports are pluggable: SFTPTransport talks to the CCMz with pysftp, and
+LocalTransport serves a local directory tree the same way, so the mirroring can
+be tried out or tested without a server.
+"""
+
+import os
+import stat
+import queue
+import shutil
+import logging
+import itertools
+import threading
+import contextlib
+import concurrent.futures
+from LPC_Instrument import metrics
+
+log = logging.getLogger(__name__)
+
+PART_SUFFIX = '.part'
+BLOCK_SIZE = 1 << 20
+
+
+class SFTPSession:
+    """
+    One pysftp connection to the CCMz
+    """
+    def __init__(self, host, username, password):
+        import pysftp  #only needed for the real server
+        self.sftp = pysftp.Connection(host=host, username=username, password=password)
+
+    def listdir(self, folder):
+        """
+        List the regular files in a remote folder as (filename, size, mtime) tuples
+        """
+        return [(f.filename, f.st_size, f.st_mtime) for f in self.sftp.listdir_attr(folder)
+                if stat.S_ISREG(f.st_mode)]
+
+    def open(self, path):
+        return self.sftp.open(path, 'rb')
+
+    def close(self):
+        self.sftp.close()
+
+class LocalSession:
+    """
+    Filesystem-backed stand-in for an SFTP session rooted at a local directory
+    """
+    def __init__(self, root):
+        self.root = root
+
+    def listdir(self, folder):
+        path = os.path.join(self.root, folder)
+        return [(e.name, e.stat().st_size, e.stat().st_mtime) for e in os.scandir(path) if e.is_file()]
+
+    def open(self, path):
+        return open(os.path.join(self.root, path), 'rb')
+
+    def close(self):
+        pass
+
+class SFTPTransport:
+    def __init__(self, host, username, password):
+        self.host = host
+        self.username = username
+        self.password = password
+
+    def connect(self):
+        return SFTPSession(self.host, self.username, self.password)
+
+class LocalTransport:
+    def __init__(self, root):
+        self.root = root
+
+    def connect(self):
+        return LocalSession(self.root)
+
+class SessionPool:
+    """
+    A pool of up to size sessions from transport, opened as they are needed and
+    shared by all the folders that are mirrored.  A session whose use raised is
+    closed and dropped, so the next caller opens a new connection.
+    """
+    def __init__(self, transport, size = 4):
+        self.transport = transport
+        self.size = size
+        self.idle = queue.Queue()
+        self.opened = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def session(self):
+        session = None
+        while session is None:
+            try:
+                session = self.idle.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    if len(self.opened) < self.size:
+                        session = self.transport.connect()
+                        self.opened.append(session)
+                if session is None:  #wait for one to come back, or for a failed one to be dropped
+                    try:
+                        session = self.idle.get(timeout = 1)
+                    except queue.Empty:
+                        pass
+        try:
+            yield session
+        except BaseException:
+            self.discard(session)
+            raise
+        self.idle.put(session)
+
+    def discard(self, session):
+        with self.lock:
+            if session in self.opened:
+                self.opened.remove(session)
+        try:
+            session.close()
+        except Exception as e:
+            log.debug('closing a failed session error=%r', e)
+
+    def close(self):
+        for session in self.opened:
+            session.close()
+        self.opened = []
+        self.idle = queue.Queue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def download_file(pool, remote_path, local_path, size, mtime):
+    """
+    Download one file to local_path + '.part', resuming a previous partial download,
+    then rename it to local_path and set its modification time to the remote one
+    """
+    part = local_path + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset > size:
+        offset = 0
+    with pool.session() as session, metrics.stage('download'):
+        with session.open(remote_path) as remote, open(part, 'r+b' if offset else 'wb') as local:
+            remote.seek(offset)
+            local.seek(offset)
+            local.truncate()
+            shutil.copyfileobj(remote, local, BLOCK_SIZE)
+    if os.path.getsize(part) != size:
+        raise IOError('Incomplete download of ' + remote_path)
+    metrics.count('files_downloaded')
+    metrics.count('bytes_downloaded', size - offset)
+    os.utime(part, (mtime, mtime))
+    os.replace(part, local_path)
+    return local_path
+
+def mirror_folder(pool, folder, local_folder, workers = 4, show_individual_file = True, known = None, on_result = None):
+    """
+    Download every file in the remote folder that is not in local_folder yet.
+    known optionally gives the set of filenames that are already downloaded
+    instead of listing local_folder.  on_result(filename, size, mtime, local_path,
+    error) is called in the calling thread as each download finishes, with error
+    None on success.  At most workers downloads are started ahead of on_result, so
+    when it blocks the downloads wait for it.  Returns the sorted list of downloaded files and a list of
+    (file, error) tuples for downloads that failed.  Raises IOError if the remote
+    folder does not exist.
+    """
+    if not os.path.exists(local_folder):
+        os.makedirs(local_folder)
+
+    with pool.session() as session, metrics.stage('sftp_list'):
+        remote_files = session.listdir(folder)
+    if known is None:
+        known = set(os.listdir(local_folder))
+    to_download = sorted(f for f in remote_files if f[0] not in known)
+
+    downloaded = []
+    failures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers = workers) as executor:
+        futures = dict()
+        remaining = iter(to_download)
+        while True:
+            for filename, size, mtime in itertools.islice(remaining, workers - len(futures)):
+                if show_individual_file == True:
+                    log.info('downloading file=%s', filename)
+                future = executor.submit(download_file, pool, folder + '/' + filename,
+                                         os.path.join(local_folder, filename), size, mtime)
+                futures[future] = (filename, size, mtime)
+            if len(futures) == 0:
+                break
+            done, pending = concurrent.futures.wait(futures, return_when = concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                filename, size, mtime = futures.pop(future)
+                try:
+                    local_path = future.result()
+                    downloaded.append(local_path)
+                    error = None
+                except Exception as e:
+                    local_path = None
+                    error = repr(e)
+                    failures.append((filename, error))
+                if on_result is not None:
+                    on_result(filename, size, mtime, local_path, error)
+
+    return sorted(downloaded), sorted(failures)
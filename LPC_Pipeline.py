@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bounded hand-off between the download, conversion and aggregation stages.
+
+GetLPC's pipelined mode queues each TM file for conversion as soon as its
+download completes and adds each flight to its master files on a background
+thread (a ProcessingQueue, see LPC_Watch) while the next flight downloads, so
+the network and the CPUs are busy at the same time.  BoundedExecutor keeps that
+bounded: it wraps a process pool so that at most max_pending jobs are submitted
+and not finished, and submit blocks until one finishes.  It is called from
+the on_result callback of LPC_Mirror.mirror_folder as each download completes,
+and mirror_folder starts no more downloads while the callback blocks, so the
+downloads wait for the conversions instead of piling up work.  The time spent waiting is recorded as the 'decode_wait' stage:
+
+  with concurrent.futures.ProcessPoolExecutor(4) as pool:
+      converter = BoundedExecutor(pool, 16)
+      future = converter.submit(convert_tm_file, tm_file, csv_file)
+"""
+
+import time
+import threading
+from LPC_Instrument import metrics
+
+
+class BoundedExecutor:
+    """
+    Submits jobs to executor with at most max_pending of them unfinished at a time
+    """
+    def __init__(self, executor, max_pending):
+        self.executor = executor
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, fn, *args):
+        """
+        Same as executor.submit, waiting first until fewer than max_pending jobs are unfinished
+        """
+        t0 = time.perf_counter()
+        self.slots.acquire()
+        metrics.record('decode_wait', time.perf_counter() - t0)
+        try:
+            future = self.executor.submit(fn, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future):
+        self.slots.release()
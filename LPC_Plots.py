@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Quick look plots of the per-TM csv files.
+
+QuickLookRenderer draws the size distribution and housekeeping PNGs of a csv
+file (the same plots plotLPC always made) with the Agg object oriented API.
+The figures are built once and only the line data and titles change between
+files, so a renderer can plot a whole flight quickly.  plot_csv_files renders
+a batch of csv files in a pool of processes, one renderer per process, and
+skips every file whose PNGs are newer than the csv file:
+
+  from LPC_Plots import plot_csv_files
+  plot_csv_files(glob.glob('LPC/csv/ST2_C0_03_TTL3/*.csv'))
+"""
+
+import os
+import sys
+import glob
+import logging
+import concurrent.futures
+import numpy as np
+import matplotlib.ticker as ticker
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from LPC_SizeDist import size_distribution, LPC_BIN_LOWER, LPC_VALID_BINS
+from LPC_Instrument import metrics
+
+log = logging.getLogger(__name__)
+
+SKIP_ROWS = 7 #csv header lines and the first records, as plotLPC always skipped
+
+
+def plot_file_names(csv_file):
+    """
+    Size distribution and housekeeping PNG names for a csv file, in a 'plots' directory next to it
+    """
+    path = os.path.dirname(csv_file)
+    base = os.path.splitext(os.path.basename(csv_file))[0]
+    return os.path.join(path, 'plots', base + '_sizes.png'), os.path.join(path, 'plots', base + '_HK.png')
+
+def plots_current(csv_file):
+    """
+    True if both PNGs of a csv file exist and are newer than it
+    """
+    csv_time = os.path.getmtime(csv_file)
+    return all(os.path.exists(f) and os.path.getmtime(f) >= csv_time for f in plot_file_names(csv_file))
+
+class QuickLookRenderer:
+    """
+    Reusable size distribution and housekeeping figures
+    """
+    def __init__(self):
+        diams = LPC_BIN_LOWER[LPC_VALID_BINS]/1000
+        self.size_fig = Figure(figsize = (9,9))
+        FigureCanvasAgg(self.size_fig)
+        ax1 = self.size_fig.add_subplot(1,1,1)
+        self.size_lines = [ax1.plot(diams, np.ones(len(diams)), fmt)[0] for fmt in ('r-', 'r.', 'r.')]
+        ax1.set_xlabel('Diameter [um]')
+        ax1.set_ylabel('dN/dlogD [#/cc]')
+        ax1.set_xscale('log')
+        ax1.set_yscale('log')
+        ax1.set_xlim([0.3,24])
+        ax1.xaxis.set_minor_locator(ticker.FixedLocator([0.3,0.5,1.0,2.0,4.0,8.0,16.0]))
+        ax1.xaxis.set_major_locator(ticker.NullLocator())
+        ax1.xaxis.set_minor_formatter(ticker.ScalarFormatter())
+        self.size_ax = ax1
+
+        self.hk_fig = Figure(figsize = (9,9))
+        FigureCanvasAgg(self.hk_fig)
+        axes = self.hk_fig.subplots(2, 2)
+        #(axis, y label, [(column, format, label)]) of each housekeeping panel
+        panels = [(axes[0,0], 'Current [mA]', [(1, 'r-', 'Pump1'), (2, 'b-', 'Pump2')]),
+                  (axes[0,1], 'Temperature [C]', [(10, 'r-', 'Pump1'), (11, 'b-', 'Pump2')]),
+                  (axes[1,0], 'Temperature [C]', [(12, 'g-', 'Laser'), (13, 'm-', 'DCDC Conv.'), (14, 'c-', 'Inlet')]),
+                  (axes[1,1], 'Flow [SLPM]', [(8, 'k-', None)])]
+        self.hk_lines = []
+        for ax, ylabel, lines in panels:
+            for column, fmt, label in lines:
+                self.hk_lines.append((column, ax.plot([0], [0], fmt, label = label)[0]))
+            if lines[0][2] is not None:
+                ax.legend(loc='upper left')
+            ax.set_ylabel(ylabel)
+            ax.set_xlabel('Elapsed Time [s]')
+        axes[0,0].set_ylim(0,1000)
+        self.hk_axes = [axes[0,1], axes[1,0], axes[1,1]] #autoscaled panels
+        self.hk_title = self.hk_fig.suptitle('')
+
+    def render(self, csv_file):
+        """
+        Write the two PNGs of one csv file, returns their names
+        """
+        figFile_size, figFile_hk = plot_file_names(csv_file)
+        LPCdata = np.loadtxt(csv_file, skiprows = SKIP_ROWS, delimiter = ',', ndmin = 2)
+        return self.render_rows(LPCdata, os.path.basename(csv_file), figFile_size, figFile_hk)
+
+    def render_rows(self, LPCdata, title, figFile_size, figFile_hk):
+        """
+        Write the two PNGs of float rows with the 47 csv columns
+        """
+        if len(LPCdata) < 2:
+            raise ValueError('Not enough records to plot')
+        os.makedirs(os.path.dirname(figFile_size), exist_ok = True)
+
+        szd = size_distribution(LPCdata[:,15:], LPCdata[:,8], LPCdata[:,0])
+        dndlogd = szd['dNdlogD'][:,LPC_VALID_BINS]
+        mean_dndlogd = np.nanmean(dndlogd,0)
+        std_dndlogd = np.nanstd(dndlogd,0)
+        for line, values in zip(self.size_lines, (mean_dndlogd, mean_dndlogd + std_dndlogd, mean_dndlogd - std_dndlogd)):
+            line.set_ydata(values)
+        self.size_ax.relim()
+        self.size_ax.autoscale_view(scalex = False)
+        self.size_ax.set_title(title)
+        self.size_fig.savefig(figFile_size)
+
+        time = LPCdata[:,0] - LPCdata[0,0]
+        for column, line in self.hk_lines:
+            line.set_data(time, LPCdata[:,column])
+        for ax in self.hk_axes:
+            ax.relim()
+            ax.autoscale_view()
+        self.hk_lines[0][1].axes.set_xlim(time[0], time[-1])
+        self.hk_title.set_text(title)
+        self.hk_fig.savefig(figFile_hk)
+        return figFile_size, figFile_hk
+
+def plotLPC(filename):
+    """
+    Make the quick look plots of one csv file, see plot_csv_files for plotting many files
+    """
+    return QuickLookRenderer().render(filename)
+
+_renderer = None
+
+def render_csv_file(csv_file):
+    """
+    Plot one csv file with this process's renderer.  Runs in a worker process, so
+    errors are returned rather than raised.
+    """
+    global _renderer
+    if _renderer is None:
+        _renderer = QuickLookRenderer()
+    try:
+        _renderer.render(csv_file)
+    except Exception as e:
+        return repr(e)
+    return None
+
+def plot_flight_data(flight, plot_dir):
+    """
+    Plot every source (TM or csv file) of an LPCFlightData (see LPC_FlightData)
+    into plot_dir with one renderer, skipping the first record of each as the csv
+    plots do.  Returns the number of sources plotted.
+    """
+    renderer = QuickLookRenderer()
+    plotted = 0
+    for s in flight.sources:
+        base = os.path.basename(s['source']).split('.')[0]
+        try:
+            with metrics.stage('plot'):
+                renderer.render_rows(flight.rows(s['start'] + 1, s['start'] + s['rows']), base + '.csv',
+                                     os.path.join(plot_dir, base + '_sizes.png'), os.path.join(plot_dir, base + '_HK.png'))
+            plotted += 1
+        except Exception as e:
+            log.warning('unable to plot file=%s error=%s', os.path.basename(s['source']), repr(e))
+    metrics.count('plots', plotted)
+    return plotted
+
+def plot_csv_files(csv_files, max_workers = 4, force = False, mp_context = None):
+    """
+    Make the quick look plots of a batch of csv files using max_workers processes
+    started with mp_context (the default start method if None), skipping files whose
+    plots are up to date unless force is set.  Returns the list
+    of files plotted and a list of (csv file, error) tuples for the ones that failed.
+    """
+    csv_files = sorted(f for f in csv_files if force or not plots_current(f))
+    with metrics.stage('plot'):
+        if max_workers == 1 or len(csv_files) < 2:
+            results = [render_csv_file(f) for f in csv_files]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers, mp_context = mp_context) as pool:
+                results = list(pool.map(render_csv_file, csv_files, chunksize = max(len(csv_files) // (4 * max_workers), 1)))
+
+    plotted = [f for f, error in zip(csv_files, results) if error is None]
+    failures = [(f, error) for f, error in zip(csv_files, results) if error is not None]
+    metrics.count('plots', len(plotted))
+    for csv_file, error in failures:
+        log.warning('unable to plot file=%s error=%s', os.path.basename(csv_file), error)
+    if len(csv_files) > 0:
+        log.info('plots=%d of=%d', len(plotted), len(csv_files))
+    return plotted, failures
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 LPC_Plots.py csv_dir [max_workers]')
+        return
+    logging.basicConfig(level = logging.INFO, format = '%(asctime)s %(levelname)s %(name)s %(message)s')
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    plot_csv_files(glob.glob(os.path.join(sys.argv[1], '*.csv')), max_workers)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Time-indexed queries over a whole flight.
+
+LPCQuery opens a columnar store (or a master/mean csv file through LPCDataset)
+and sorts its per-TM chunks by start time.  Time-range queries only read the
+chunks that overlap the range, and column predicates skip every chunk whose
+min/max (kept in the store index) rules it out, so only the needed parts of the
+memory-mapped columns are touched.  For example:
+
+  from LPC_Query import LPCQuery
+  q = LPCQuery('LPC/ST2_C0_03_TTL3_LPC_Master.csv')
+  szd = q.time_range(t_start, t_end, ['Time', 'Flow', 'Bins'])
+  cold = q.where('Inlet_T', '<', -60)
+
+Results are dicts of column arrays plus 'Row', the row numbers in the dataset.
+The chunk times are the range of the Time column of each chunk.
+"""
+
+import operator
+import numpy as np
+from LPC_Columnar import *
+from LPC_Dataset import LPCDataset
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+             '==': operator.eq, '!=': operator.ne}
+
+
+class LPCQuery:
+    """
+    Chunk-level time index over a columnar store or a master/mean csv file
+    """
+    def __init__(self, source):
+        if source.endswith('.csv'):
+            source = LPCDataset(source).store_dir
+        self.store_dir = source
+        self.index = read_store_index(source)
+        self.columns = load_store(source)
+        self.names = [name for name, width in self.index['columns']]
+        chunks = [c for c in self.index['chunks'] if c['t0'] is not None and c['rows'] > 0]
+        chunks.sort(key = lambda c: c['t0'])
+        self.chunks = chunks
+        self.t0 = np.array([c['t0'] for c in chunks])
+        #latest end time of any chunk up to each position, so overlaps are found with a bisection
+        self.t1_max = np.maximum.accumulate(np.array([c['t1'] for c in chunks])) if chunks else np.zeros(0)
+
+    def chunks_between(self, t_start, t_end):
+        """
+        Chunks whose time range overlaps [t_start, t_end]
+        """
+        last = np.searchsorted(self.t0, t_end, side = 'right')
+        first = np.searchsorted(self.t1_max[:last], t_start, side = 'left')
+        return [c for c in self.chunks[first:last] if c['t1'] >= t_start]
+
+    def read_rows(self, chunks, mask_func, columns = None):
+        """
+        Read the rows of each chunk selected by mask_func(slice of the chunk rows),
+        which returns a boolean mask, and return them as one dict of arrays
+        """
+        columns = self.names if columns is None else columns
+        parts = {name: [] for name in columns}
+        parts['Row'] = []
+        for chunk in chunks:
+            rows = slice(chunk['start'], chunk['start'] + chunk['rows'])
+            mask = mask_func(rows)
+            if not mask.any():
+                continue
+            for name in columns:
+                parts[name].append(np.asarray(self.columns[name][rows][mask]))
+            parts['Row'].append(np.arange(rows.start, rows.stop)[mask])
+        result = dict()
+        for name, values in parts.items():
+            if len(values) > 0:
+                result[name] = np.concatenate(values)
+            elif name == 'Row':
+                result[name] = np.zeros(0, dtype = int)
+            else:
+                result[name] = np.zeros((0,) + self.columns[name].shape[1:])
+        return result
+
+    def time_range(self, t_start, t_end, columns = None):
+        """
+        All the records with t_start <= Time <= t_end
+        """
+        time = self.columns['Time']
+        return self.read_rows(self.chunks_between(t_start, t_end),
+                              lambda rows: (time[rows] >= t_start) & (time[rows] <= t_end), columns)
+
+    def where(self, column, op, value, t_start = None, t_end = None, columns = None):
+        """
+        All the records where 'column op value' holds for one of the HK columns, e.g.
+        where('Inlet_T', '<', -60), optionally limited to a time range
+        """
+        compare = OPERATORS[op]
+        chunks = self.chunks
+        if t_start is not None or t_end is not None:
+            chunks = self.chunks_between(-np.inf if t_start is None else t_start, np.inf if t_end is None else t_end)
+        k = [name for name, width in self.index['columns'] if width == 1].index(column)  #position in the chunk min/max
+        chunks = [c for c in chunks if chunk_may_match(c, k, op, value)]
+        time = self.columns['Time']
+        values = self.columns[column]
+        def mask(rows):
+            selected = compare(values[rows], value)
+            if t_start is not None:
+                selected &= time[rows] >= t_start
+            if t_end is not None:
+                selected &= time[rows] <= t_end
+            return selected
+        return self.read_rows(chunks, mask, columns)
+
+    def row_at(self, t):
+        """
+        Row number of the record closest in time to t
+        """
+        chunks = self.chunks_between(t, t)
+        if len(chunks) == 0:  #between chunks, look at the nearest ones on either side
+            k = np.searchsorted(self.t0, t)
+            chunks = self.chunks[max(k-1, 0):k+1]
+        best = None
+        for chunk in chunks:
+            time = np.asarray(self.columns['Time'][chunk['start']:chunk['start'] + chunk['rows']])
+            i = int(np.nanargmin(np.abs(time - t)))
+            if best is None or abs(time[i] - t) < best[0]:
+                best = (abs(time[i] - t), chunk['start'] + i)
+        return None if best is None else best[1]
+
+def chunk_may_match(chunk, k, op, value):
+    """
+    False if the min/max of column k in the chunk show no row can satisfy 'op value'
+    """
+    if 'min' not in chunk:
+        return True
+    low = chunk['min'][k]
+    high = chunk['max'][k]
+    if low is None:
+        return False
+    if op in ('<', '<='):
+        return OPERATORS[op](low, value)
+    if op in ('>', '>='):
+        return OPERATORS[op](high, value)
+    if op == '==':
+        return low <= value <= high
+    return not (low == high == value)
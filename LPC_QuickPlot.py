@@ -12,89 +12,136 @@ import matplotlib.pyplot as plt
 from datetime import datetime
 from datetime import timezone
 from matplotlib.widgets import Slider, Button
+from LPC_Dataset import LPCDataset
+from LPC_Query import LPCQuery
+from LPC_SizeDist import size_distribution, sample_interval, LPC_BIN_LOWER, LPC_VALID_BINS
+from LPC_Resample import resampled_store_name
+from LPC_Timeline import TimelineView
 
 
 LPCcsv = 'LPC/LPC_Mean.csv'
 
-if len(sys.argv) > 1:
-    if sys.argv[1] == 'master':
-        LPCcsv = 'LPC/LPC_Master.csv'
-        print("Plotting ALL LPC records")
-        
-LPC = np.genfromtxt(LPCcsv,skip_header=2,delimiter=',')
-LPC_time = LPC[:,0]
 LPC_diams = np.array([275,300,325,350,375,400,450,500,550,600,650,700,750,800,900,1000,1200,1400,1600,1800,2000,2500,3000,3500,4000,6000,8000,10000,13000,16000,24000])
-LPC_conc = LPC[:,15:46]
-LPC_Pump1_T = LPC[:,10] 
-LPC_Pump2_T = LPC[:,11]
-LPC_Inlet_T = LPC[:,14]
-LPC_Flow = LPC[:,8]
-LPC_Vin = LPC[:,7]
-
-# Define initial parameters
-init_szd = len(LPC_Flow)-1
-
-# Create the figure and the line that we will manipulate
-fig1, ax1 = plt.subplots()
-line, = plt.plot(LPC_diams, LPC_conc[init_szd,:], lw=2)
-ax1.set_xlabel('Diameter [nm]')
-ax1.set_ylabel('Concentration')
-ax1.set_yscale('log')
-ax1.set_xscale('log')
-ax1.set_xlim(300,24000)
-annotation = 'Flow: ' + "{:.2f}".format(LPC_Flow[init_szd]) + '\nT_Pump1: ' + "{:.2f}".format(LPC_Pump1_T[init_szd])+ '\nT_Pump2: ' + "{:.2f}".format(LPC_Pump2_T[init_szd])+ '\nT_Inlet: ' + "{:.2f}".format(LPC_Inlet_T[init_szd])+ '\nV_in: ' + "{:.2f}".format(LPC_Vin[init_szd])
-text = ax1.text(0.6,0.7,annotation, transform=ax1.transAxes)
-date_time = datetime.fromtimestamp(int(LPC_time[init_szd]),tz=timezone.utc)
-d = date_time.strftime("%m/%d/%Y, %H:%M:%S")
-ax1.set_title("LPC Size Distribution at: "+d)
-axcolor = 'lightgoldenrodyellow'
-ax1.margins(x=0)
-
-# adjust the main plot to make room for the sliders
-plt.subplots_adjust(bottom=0.25)
-
-# Make a horizontal slider to control which szd we plot.
-axszd = plt.axes([0.25, 0.1, 0.65, 0.03], facecolor=axcolor)
-szd_slider = Slider(
-    ax=axszd,
-    label='Scan Number',
-    valmin=0,
-    valmax=len(LPC_Flow),
-    valinit=init_szd,
-    valfmt="%i"
-)
-
-# The function to be called anytime a slider's value changes
-def update(val):
-    print('Plotting Scan: ' + str(int(szd_slider.val)))
-    annotation = 'Flow: ' + "{:.2f}".format(LPC_Flow[int(szd_slider.val)]) + '\nT_Pump1: ' + "{:.2f}".format(LPC_Pump1_T[int(szd_slider.val)])+ '\nT_Pump2: ' + "{:.2f}".format(LPC_Pump2_T[int(szd_slider.val)])+ '\nT_Inlet: ' + "{:.2f}".format(LPC_Inlet_T[int(szd_slider.val)])+ '\nV_in: ' + "{:.2f}".format(LPC_Vin[int(szd_slider.val)])
-    text.set_text(annotation)
-    date_time = datetime.fromtimestamp(int(LPC_time[int(szd_slider.val)]),tz=timezone.utc)
-    d = date_time.strftime("%m/%d/%Y, %H:%M:%S")
-    ax1.set_title("LPC Size Distribution at: "+d)
-    line.set_ydata(LPC_conc[int(szd_slider.val),:])
-    fig1.canvas.draw_idle()
-
-
-# register the update function with each slider
-szd_slider.on_changed(update)
-#amp_slider.on_changed(update)
-
-# Create a `matplotlib.widgets.Button` to reset the sliders to initial values.
-nextax = plt.axes([0.8, 0.025, 0.1, 0.04])
-button_next = Button(nextax, 'Next', color=axcolor, hovercolor='0.975')
-prevax = plt.axes([0.68, 0.025, 0.1, 0.04])
-button_prev = Button(prevax, 'Prev', color=axcolor, hovercolor='0.975')
 
+def scan_annotation(scan):
+    return 'Flow: ' + "{:.2f}".format(scan['Flow']) + '\nT_Pump1: ' + "{:.2f}".format(scan['Pump1_T'])+ '\nT_Pump2: ' + "{:.2f}".format(scan['Pump2_T'])+ '\nT_Inlet: ' + "{:.2f}".format(scan['Inlet_T'])+ '\nV_in: ' + "{:.2f}".format(scan['Input_V'])
 
-def b_next(event):
-    szd_slider.set_val(szd_slider.val + 1)
-    update(szd_slider.val + 1)
-def b_prev(event):
-    szd_slider.set_val(szd_slider.val - 1)
-    update(szd_slider.val - 1)
-
-button_next.on_clicked(b_next)
-button_prev.on_clicked(b_prev)
-
-plt.show()
\ No newline at end of file
+def scan_title(scan):
+    date_time = datetime.fromtimestamp(int(scan['Time']),tz=timezone.utc)
+    d = date_time.strftime("%m/%d/%Y, %H:%M:%S")
+    return "LPC Size Distribution at: "+d
+
+def scan_values(scan, dt):
+    """
+    What is plotted for a scan: the raw bin counts, or dN/dlogD when the sample time dt is known
+    or the scan is from a resampled product
+    """
+    if 'dNdlogD' in scan:
+        return scan['dNdlogD'][LPC_VALID_BINS]
+    if dt is None:
+        return scan['Bins'][:31]
+    return size_distribution(scan['Bins'], scan['Flow'], dt = dt)['dNdlogD'][0,LPC_VALID_BINS]
+
+def quick_plot(LPC, init_szd = None, dt = None):
+    """
+    Interactive size distribution plot of an LPCDataset (or LPCFlightData), only the
+    scan that is displayed is read from the dataset.  Starts at scan init_szd, by default the last.
+    With the sample time dt in s, or for a resampled product, the plot shows dN/dlogD
+    instead of the raw counts.
+    """
+    # Define initial parameters
+    if init_szd is None:
+        init_szd = len(LPC)-1
+    scan = LPC.scan(init_szd)
+
+    # Create the figure and the line that we will manipulate
+    fig1, ax1 = plt.subplots()
+    counts = dt is None and 'dNdlogD' not in scan
+    line, = plt.plot(LPC_diams if counts else LPC_BIN_LOWER[LPC_VALID_BINS], scan_values(scan, dt), lw=2)
+    ax1.set_xlabel('Diameter [nm]')
+    ax1.set_ylabel('Concentration' if counts else 'dN/dlogD [#/cc]')
+    ax1.set_yscale('log')
+    ax1.set_xscale('log')
+    ax1.set_xlim(300,24000)
+    text = ax1.text(0.6,0.7,scan_annotation(scan), transform=ax1.transAxes)
+    ax1.set_title(scan_title(scan))
+    axcolor = 'lightgoldenrodyellow'
+    ax1.margins(x=0)
+
+    # adjust the main plot to make room for the sliders
+    plt.subplots_adjust(bottom=0.25)
+
+    # Make a horizontal slider to control which szd we plot.
+    axszd = plt.axes([0.25, 0.1, 0.65, 0.03], facecolor=axcolor)
+    szd_slider = Slider(
+        ax=axszd,
+        label='Scan Number',
+        valmin=0,
+        valmax=len(LPC)-1,
+        valinit=init_szd,
+        valfmt="%i"
+    )
+
+    # The function to be called anytime a slider's value changes
+    def update(val):
+        i = min(max(int(szd_slider.val), 0), len(LPC)-1)
+        print('Plotting Scan: ' + str(i))
+        scan = LPC.scan(i)
+        text.set_text(scan_annotation(scan))
+        ax1.set_title(scan_title(scan))
+        line.set_ydata(scan_values(scan, dt))
+        fig1.canvas.draw_idle()
+
+    # register the update function with each slider
+    szd_slider.on_changed(update)
+
+    # Create a `matplotlib.widgets.Button` to reset the sliders to initial values.
+    nextax = plt.axes([0.8, 0.025, 0.1, 0.04])
+    button_next = Button(nextax, 'Next', color=axcolor, hovercolor='0.975')
+    prevax = plt.axes([0.68, 0.025, 0.1, 0.04])
+    button_prev = Button(prevax, 'Prev', color=axcolor, hovercolor='0.975')
+
+    def b_next(event):
+        szd_slider.set_val(min(szd_slider.val + 1, len(LPC)-1))
+    def b_prev(event):
+        szd_slider.set_val(max(szd_slider.val - 1, 0))
+
+    button_next.on_clicked(b_next)
+    button_prev.on_clicked(b_prev)
+
+    #keep references to the widgets so they are not garbage collected
+    fig1.widgets = (szd_slider, button_next, button_prev)
+    return fig1
+
+def main():
+    csv_file = LPCcsv
+    master = False
+    args = sys.argv[1:]
+    timeline = 'timeline' in args  #also show the whole-flight timeline
+    if timeline:
+        args.remove('timeline')
+    if len(args) > 0 and args[0] == 'master':
+        csv_file = 'LPC/LPC_Master.csv'
+        master = True
+        print("Plotting ALL LPC records")
+        args = args[1:]
+    elif len(args) > 1 and args[0] == 'resampled':  #a product of LPC_Resample, e.g. resampled 600
+        csv_file = resampled_store_name('LPC/LPC_Master.csv', float(args[1]))
+        print("Plotting " + args[1] + " s averages of the LPC records")
+        args = args[2:]
+
+    LPC = LPCDataset(csv_file)
+    dt = None
+    if master:  #consecutive records, so the sample time is known
+        dt = sample_interval(LPC.column('Time')[:1000])
+    init_szd = None
+    if len(args) > 0:  #start at the scan closest to a UTC time given as YYYY-mm-ddTHH:MM:SS
+        t = datetime.strptime(args[0], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        init_szd = LPCQuery(LPC.store_dir).row_at(t)
+    fig = quick_plot(LPC, init_szd, dt)
+    if timeline:
+        view = TimelineView(LPC, fig.widgets[0], dt)
+    plt.show()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of decoded TM files.
+
+Each TM file is decoded once and its raw records (the structured uint16 array
+from decodeLPCrecords), scaled housekeeping columns, binary header, message ID
+first state message, XML header and quality are saved to
+<cache_dir>/<sha1 of the TM file>_v<LPC_DECODER_VERSION>.tm, which is read
+back with a single read and no parsing of the records.  The key is the content of the gzipped file, so a renamed or re-downloaded file
+hits the same entry and a changed one does not.  Entries whose HK scaling is
+older than LPC_HK_VERSION are rescaled from the raw records without touching
+gzip.  The cache is kept under max_bytes by removing the least recently used
+entries.
+
+  cache = RecordCache('LPC/record_cache')
+  TM = cache.read_tm('xxx.LPC.dat.gz')   #same dict as readTM, plus 'HK'
+  writeLPCcsv(TM, 'xxx.LPC.csv')
+"""
+
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+from readLPCXML import *
+from LPC_Instrument import metrics
+
+HASH_BLOCK = 1 << 20
+
+
+def file_hash(filename):
+    """
+    sha1 hex digest of the contents of a file
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class RecordCache:
+    """
+    Size bounded, least recently used cache of decoded TM files in cache_dir
+    """
+    def __init__(self, cache_dir, max_bytes = 2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok = True)
+
+    def entry_name(self, tm_file):
+        return os.path.join(self.cache_dir, file_hash(tm_file) + '_v' + str(LPC_DECODER_VERSION) + '.tm')
+
+    def get(self, tm_file, entry = None):
+        """
+        The cached TM dict of a TM file, or None if it is not in the cache
+        """
+        entry = self.entry_name(tm_file) if entry is None else entry
+        try:
+            with open(entry, 'rb') as f:
+                buffer = f.read()
+            end = buffer.index(b'\n')
+            meta = json.loads(buffer[:end])
+            n = meta['records']
+            records = np.frombuffer(buffer, dtype = LPC_RECORD_DTYPE, count = n, offset = end + 1)
+            hk = np.frombuffer(buffer, dtype = [tuple(field) for field in meta['hk_dtype']], count = n,
+                               offset = end + 1 + n * LPC_RECORD_SIZE)
+        except (OSError, ValueError, KeyError):  #missing, evicted or half written
+            return None
+        os.utime(entry)  #most recently used
+        if meta['hk_version'] == LPC_HK_VERSION:
+            HKData = [hk[name] for name in hk.dtype.names]
+        else:
+            HKData = scaleHK(records)
+        metrics.count('cache_hits')
+        header = headerRecord(meta['XML'], meta['header_record']['StartTime'])  #typed as LPC_HEADER_SCHEMA is now
+        return {'filename': tm_file, 'XML': meta['XML'], 'header': header, 'MsgID': meta['MsgID'], 'StateMess1': meta['StateMess1'],
+                'data': memoryview(bytes.fromhex(meta['header'])), 'records': records, 'HK': HKData,
+                'quality': meta['quality']}
+
+    def put(self, tm_file, TM, entry = None):
+        """
+        Save a TM dict returned by readTM: a line of JSON with the header values,
+        then the raw records and the scaled HK columns as one structured array
+        """
+        entry = self.entry_name(tm_file) if entry is None else entry
+        HKData = TM.get('HK')
+        if HKData is None:
+            HKData = scaleHK(TM['records'])
+        hk = np.zeros(len(TM['records']), dtype = [('hk' + str(k), np.asarray(column).dtype.str) for k, column in enumerate(HKData)])
+        for k, column in enumerate(HKData):
+            hk['hk' + str(k)] = column
+        meta = {'records': len(TM['records']), 'hk_version': LPC_HK_VERSION, 'hk_dtype': hk.dtype.descr,
+                'MsgID': TM['MsgID'], 'StateMess1': TM['StateMess1'], 'header': bytes(TM['data'][:LPC_RECORD_OFFSET]).hex(),
+                'quality': TM['quality'], 'XML': TM['XML'], 'header_record': TM['header']}
+        part = entry + '.' + str(os.getpid()) + '.part'
+        with open(part, 'wb') as f:
+            f.write(json.dumps(meta).encode() + b'\n')
+            f.write(np.ascontiguousarray(TM['records']).tobytes())
+            f.write(hk.tobytes())
+        os.replace(part, entry)
+
+    def read_tm(self, tm_file):
+        """
+        Same as readTM, from the cache if the file was decoded before.  The dict
+        also has the scaled HK columns ('HK').
+        """
+        entry = self.entry_name(tm_file)
+        TM = self.get(tm_file, entry)
+        if TM is None:
+            metrics.count('cache_misses')
+            TM = readTM(tm_file)
+            TM['HK'] = scaleHK(TM['records'])
+            self.put(tm_file, TM, entry)
+        return TM
+
+    def size(self):
+        return sum(os.path.getsize(f) for f in glob.glob(os.path.join(self.cache_dir, '*.tm')))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is under max_bytes,
+        returns the number removed
+        """
+        entries = []
+        for f in glob.glob(os.path.join(self.cache_dir, '*.tm')):
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+        entries.sort()
+        total = sum(size for mtime, size, f in entries)
+        removed = 0
+        for mtime, size, f in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(f)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixed interval products from the master data of a flight.
+
+resample groups the good records (flow of at least 0.5 SLPM, as in the mean
+file) into bins of a fixed number of seconds with one sort and np.*.reduceat
+over the bin boundaries, so a whole flight is reduced in a few vectorized
+passes.  Every non empty bin gets:
+
+  Time              - start of the bin [s], same time base as the master Time column
+  N_Records         - number of good records in the bin
+  <HK field>        - mean of every HK column (values below -273 are missing)
+  <HK field>_std/_min/_max
+  Bins              - mean raw counts per record in each of the 32 channels
+  Conc, dNdlogD     - flow weighted size distribution: the counts of the bin over
+                      the volume sampled in it (see LPC_SizeDist)
+  Total, Volume     - total concentration [#/cc] and volume sampled [cc]
+
+Products are written as columnar stores next to the master file, e.g.
+LPC/ST2_C0_03_TTL3_LPC_Master_600s_store, which load with LPCDataset and plot
+with "python3 LPC_QuickPlot.py resampled 600":
+
+  from LPC_Resample import resample_master
+  resample_master('LPC/ST2_C0_03_TTL3_LPC_Master.csv', [60, 600, 3600])
+"""
+
+import os
+import sys
+import numpy as np
+from readLPCXML import LPC_HK_FIELDS
+from LPC_Columnar import *
+from LPC_Dataset import LPCDataset
+from LPC_SizeDist import size_distribution, sample_interval, N_BINS, LPC_DLOGD
+from LPC_Instrument import metrics
+
+DEFAULT_INTERVALS = [60, 600, 3600]
+HK_STATS = ['std', 'min', 'max']
+PRODUCT_COLUMNS = ([('Time', 1), ('N_Records', 1)] + [(name, 1) for name in LPC_HK_FIELDS[1:]] +
+                   [(name + '_' + stat, 1) for name in LPC_HK_FIELDS[1:] for stat in HK_STATS] +
+                   [('Bins', N_BINS), ('Conc', N_BINS), ('dNdlogD', N_BINS), ('Total', 1), ('Volume', 1)])
+
+
+def resampled_store_name(master_file_name, interval):
+    """
+    Name of the store of the interval second product of a master csv file
+    """
+    return os.path.splitext(master_file_name)[0] + '_' + str(int(interval)) + 's_store'
+
+def sorted_good_rows(columns):
+    """
+    Row numbers of the records with a flow of at least 0.5 SLPM, in time order
+    """
+    time = np.asarray(columns['Time'], dtype = float)
+    rows = np.flatnonzero(np.asarray(columns['Flow'], dtype = float) >= 0.5)
+    if np.any(np.diff(time[rows]) < 0):
+        rows = rows[np.argsort(time[rows], kind = 'stable')]
+    return rows
+
+def resample(columns, interval, dt = None, rows = None):
+    """
+    Reduce records to one row per interval seconds.  columns is a dict of master
+    columns (e.g. from load_store or LPCDataset.columns), dt the sample time in s
+    (by default the median step of the records) and rows the output of
+    sorted_good_rows, to share one sort between products.  Returns a dict of
+    arrays named as PRODUCT_COLUMNS.
+    """
+    if rows is None:
+        rows = sorted_good_rows(columns)
+    if len(rows) == 0:
+        return {name: np.zeros((0, width)) for name, width in PRODUCT_COLUMNS}
+    time = np.asarray(columns['Time'], dtype = float)[rows]
+    if dt is None:
+        dt = sample_interval(time)
+
+    bin_number = np.floor(time / interval).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, bin_number[1:] != bin_number[:-1]])
+    n = np.diff(np.r_[starts, len(time)])
+    product = {'Time': bin_number[starts] * float(interval), 'N_Records': n.astype(float)}
+
+    for name in LPC_HK_FIELDS[1:]:
+        values = np.asarray(columns[name], dtype = float)[rows]
+        values = np.where(values < -273.0, np.nan, values)
+        present = ~np.isnan(values)
+        count = np.add.reduceat(present, starts, dtype = np.int64)
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            mean = np.add.reduceat(np.where(present, values, 0.0), starts) / count
+            deviation = np.where(present, values - np.repeat(mean, n), 0.0)
+            product[name + '_std'] = np.sqrt(np.add.reduceat(deviation**2, starts) / count)
+        product[name] = mean
+        product[name + '_min'] = np.fmin.reduceat(values, starts)
+        product[name + '_max'] = np.fmax.reduceat(values, starts)
+
+    counts = np.add.reduceat(np.asarray(columns['Bins'], dtype = float)[rows], starts, axis = 0)
+    flow = np.add.reduceat(np.asarray(columns['Flow'], dtype = float)[rows], starts)
+    szd = size_distribution(counts, flow, dt = dt)  #the volume is linear in the flow, so this is the bin's volume
+    product['Bins'] = counts / n[:, None]
+    product['Conc'] = szd['conc']
+    product['dNdlogD'] = szd['dNdlogD']
+    product['Total'] = szd['total']
+    product['Volume'] = szd['volume']
+    return product
+
+def coarsen(product, interval):
+    """
+    Reduce a product (from resample) to a longer interval, which should be a multiple
+    of its own.  Also merges rows with the same bin start, e.g. from products of
+    consecutive blocks of records.  Means are weighted by the number of records,
+    concentrations by the volume sampled.
+    """
+    if len(product['Time']) == 0:
+        return product
+    time = np.asarray(product['Time'], dtype = float).reshape(-1)
+    bin_number = np.floor(time / interval).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, bin_number[1:] != bin_number[:-1]])
+    n = np.asarray(product['N_Records'], dtype = float).reshape(-1)
+    total_n = np.add.reduceat(n, starts)
+    coarse = {'Time': bin_number[starts] * float(interval), 'N_Records': total_n}
+
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        for name in LPC_HK_FIELDS[1:]:
+            mean = np.asarray(product[name], dtype = float).reshape(-1)
+            std = np.asarray(product[name + '_std'], dtype = float).reshape(-1)
+            weight = np.where(np.isnan(mean), 0.0, n)
+            total_weight = np.add.reduceat(weight, starts)
+            coarse[name] = np.add.reduceat(np.nan_to_num(mean) * weight, starts) / total_weight
+            square = np.add.reduceat(np.nan_to_num(std**2 + mean**2) * weight, starts) / total_weight
+            coarse[name + '_std'] = np.sqrt(np.maximum(square - coarse[name]**2, 0.0))
+            coarse[name + '_min'] = np.fmin.reduceat(np.asarray(product[name + '_min'], dtype = float).reshape(-1), starts)
+            coarse[name + '_max'] = np.fmax.reduceat(np.asarray(product[name + '_max'], dtype = float).reshape(-1), starts)
+
+        volume = np.asarray(product['Volume'], dtype = float).reshape(-1)
+        sampled = np.where(np.isnan(volume), 0.0, volume)
+        total_volume = np.add.reduceat(sampled, starts)
+        coarse['Bins'] = np.add.reduceat(np.asarray(product['Bins'], dtype = float) * n[:, None], starts, axis = 0) / total_n[:, None]
+        coarse['Conc'] = np.add.reduceat(np.nan_to_num(product['Conc']) * sampled[:, None], starts, axis = 0) / total_volume[:, None]
+        coarse['dNdlogD'] = coarse['Conc'] / LPC_DLOGD
+        coarse['Total'] = np.add.reduceat(np.nan_to_num(product['Total']).reshape(-1) * sampled, starts) / total_volume
+        coarse['Volume'] = np.where(total_volume > 0, total_volume, np.nan)
+    return coarse
+
+def write_product(product, store_dir, source):
+    """
+    Write a product returned by resample to a new columnar store
+    """
+    create_store(store_dir, PRODUCT_COLUMNS)
+    data = np.column_stack([np.asarray(product[name], dtype = float).reshape(len(product['Time']), width)
+                            for name, width in PRODUCT_COLUMNS])
+    if len(data) > 0:
+        append_chunk(store_dir, source, data)
+    return store_dir
+
+def resample_master(master_file_name, intervals = DEFAULT_INTERVALS, dt = None):
+    """
+    Write the products of a master csv file (or its store) for each interval in
+    seconds, returns the names of the stores
+    """
+    with metrics.stage('resample'):
+        columns = LPCDataset(master_file_name).columns
+        rows = sorted_good_rows(columns)
+        if dt is None:
+            dt = sample_interval(np.asarray(columns['Time'])[rows])
+        stores = [write_product(resample(columns, interval, dt, rows), resampled_store_name(master_file_name, interval),
+                                master_file_name) for interval in intervals]
+    metrics.count('resampled_records', len(rows))
+    return stores
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 LPC_Resample.py master_csv [interval_s ...]')
+        return
+    intervals = [float(a) for a in sys.argv[2:]] or DEFAULT_INTERVALS
+    for store in resample_master(sys.argv[1], intervals):
+        print('Wrote ' + store)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Size distribution physics for LPC records.
+
+Turns an (N records x 32 bins) array of raw counts plus the flow (and time)
+columns into the sample volume, number concentration per bin, dN/dlogD and
+cumulative concentration of every record in one vectorized pass.  Works on
+arrays from a per-TM csv, the master data or a columnar store alike.
+
+Bins: each value in LPC_DIAMS is the lower edge of a bin in nm.  The last two
+channels both start at 24000 nm; the first of them is treated as open ended
+with the same width in log space as the bin below it, and the second one is a
+duplicate that is left out of dN/dlogD and the cumulative concentration.
+"""
+
+import numpy as np
+from readLPCXML import LPC_DIAMS
+from LPC_Columnar import *
+
+N_BINS = 32
+LPC_BIN_LOWER = np.array(LPC_DIAMS, dtype = float)
+LPC_BIN_UPPER = np.append(LPC_BIN_LOWER[1:31], LPC_BIN_LOWER[30]**2 / LPC_BIN_LOWER[29])
+LPC_BIN_UPPER = np.append(LPC_BIN_UPPER, np.nan)  #duplicate 24000 nm channel
+LPC_DLOGD = np.log10(LPC_BIN_UPPER / LPC_BIN_LOWER)
+LPC_VALID_BINS = np.isfinite(LPC_DLOGD)
+
+
+def sample_interval(time):
+    """
+    Time between records in s: the median of the positive steps in the time column,
+    which is not thrown off by gaps between TM files
+    """
+    steps = np.diff(np.asarray(time, dtype = float))
+    steps = steps[steps > 0]
+    if len(steps) == 0:
+        raise ValueError('Need at least two records with different times to find the sample interval')
+    return float(np.median(steps))
+
+def sample_volume(flow, dt):
+    """
+    Volume in cc sampled by each record from the flow in SLPM and the sample time in s
+    """
+    return np.asarray(flow, dtype = float) * 1000.0 * dt / 60.0
+
+def size_distribution(counts, flow, time = None, dt = None):
+    """
+    Compute the size distribution of every record.  counts is (N x 32) raw counts,
+    flow is the flow in SLPM, and dt the sample time in s (if None it is found
+    from time with sample_interval).  Returns a dict of arrays:
+
+      'volume'      - sample volume per record [cc]
+      'conc'        - number concentration per bin [#/cc]
+      'dNdlogD'     - dN/dlogD per bin [#/cc], NaN for the duplicate channel
+      'cumulative'  - concentration of particles larger than each bin's lower edge [#/cc]
+      'total'       - total concentration [#/cc]
+
+    Records with no flow get NaN concentrations.
+    """
+    counts = np.asarray(counts, dtype = float).reshape(-1, N_BINS)
+    if dt is None:
+        dt = sample_interval(time)
+    volume = sample_volume(flow, dt).reshape(-1)
+    volume = np.where(volume > 0, volume, np.nan)
+
+    conc = counts / volume[:, None]
+    valid = np.where(LPC_VALID_BINS, conc, 0.0)
+    cumulative = np.cumsum(valid[:, ::-1], axis = 1)[:, ::-1]
+    cumulative[:, ~LPC_VALID_BINS] = np.nan
+    dNdlogD = conc / LPC_DLOGD  #NaN where the width is not defined
+
+    return {'volume': volume, 'conc': conc, 'dNdlogD': dNdlogD,
+            'cumulative': cumulative, 'total': cumulative[:, 0]}
+
+def store_size_distribution(store_dir, out_dir, dt = None):
+    """
+    Write the volume, total concentration and dN/dlogD of every record in a master
+    store to a new store out_dir, one TM chunk at a time.  dt defaults to the
+    sample interval of the whole store.
+    """
+    index = read_store_index(store_dir)
+    store = load_store(store_dir, ['Time', 'Flow', 'Bins'])
+    if dt is None:
+        dt = sample_interval(store['Time'])
+    create_store(out_dir, [('Time', 1), ('Volume', 1), ('Total', 1), ('dNdlogD', N_BINS)])
+    with StoreWriter(out_dir) as writer:
+        for chunk in index['chunks']:
+            rows = slice(chunk['start'], chunk['start'] + chunk['rows'])
+            szd = size_distribution(store['Bins'][rows], store['Flow'][rows], dt = dt)
+            writer.append(chunk['source'], np.column_stack((store['Time'][rows], szd['volume'],
+                                                            szd['total'], szd['dNdlogD'])))
+    return dt
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming processing of LPC TM files.
+
+iter_records reads a gzipped TM file in blocks and yields the records of its
+binary section in batches, and iter_flight does the same for every TM file of
+a flight.  Sinks consume (filename, batch) pairs, where batch is a float array
+with the same 47 columns as the csv files:
+
+  MasterCSVSink   - writes a master csv file
+  MeanSink        - writes a mean csv file (and statistics file), one line per TM file
+  ColumnarSink    - appends to a columnar store (see LPC_Columnar)
+
+Memory use is bounded by the batch size and not by the size of a TM file or
+flight, e.g. to write the master and mean files of a flight straight from the
+TM files:
+
+  stream_flight('LPC_Test/ST2_C0_03_TTL3/LPC/Flight/TM/Processed',
+                'LPC/ST2_C0_03_TTL3_LPC_Mean.csv', 'LPC/ST2_C0_03_TTL3_LPC_Master.csv')
+"""
+
+import io
+import struct
+import os
+import csv
+import glob
+import gzip
+import numpy as np
+from readLPCXML import *
+from LPC_Columnar import *
+from LPC_Make_Master_CSVs import MeanAccumulator, write_mean, stats_header, MST_TO_UTC
+
+READ_BLOCK = 1 << 16
+HEADER_BLOCKS = 4 #blocks read looking for the XML header
+
+
+def iter_records(tm_path, batch_records = 4096):
+    """
+    Yield the good records of a gzipped TM file as structured arrays (LPC_RECORD_DTYPE)
+    of at most batch_records records, reading the file in blocks.  The binary
+    section is framed and the records checked the same way as readTM (see frameTM
+    and validateLPCrecords), so an END inside the records or a missing final END
+    does not cut the file short.  The XML header is looked for in the first
+    HEADER_BLOCKS blocks.
+    """
+    with gzip.open(tm_path, 'rb') as f:
+        buffer = b''
+        for k in range(HEADER_BLOCKS):  #read the XML header
+            block = f.read(READ_BLOCK)
+            buffer += block
+            header_end = buffer.find(b'</CRC>')
+            if len(block) == 0 or (header_end >= 0 and buffer.find(b'START', header_end) >= 0):
+                break
+        marker = findSectionStart(buffer)
+        if marker < 0:
+            return
+        length = headerLength(buffer[:marker])
+        buffer = buffer[marker+5:]
+
+        #The section ends at <Length> if 'END' is there, otherwise at an 'END' in the last
+        #LPC_END_SLACK+3 bytes of the file or at the end of the file.  Records are only
+        #decoded up to <Length> and not from the last LPC_END_SLACK+3 bytes read, which
+        #may turn out to be after the end.
+        hold = LPC_END_SLACK + 3
+        consumed = 0  #bytes of the section dropped from the front of buffer
+        at_end = False  #the whole file has been read
+        end = None  #end of the section in buffer, once known
+        start_time = None
+        batch_bytes = batch_records * LPC_RECORD_SIZE
+        while True:
+            while end is None and not at_end and len(buffer) < LPC_RECORD_OFFSET + batch_bytes + hold:
+                block = f.read(max(READ_BLOCK, batch_bytes))
+                at_end = len(block) == 0
+                buffer += block
+            if end is None and length is not None and len(buffer) >= length - consumed + 3:
+                if buffer[length-consumed:length-consumed+3] == b'END':
+                    end = length - consumed
+                else:
+                    length = None  #wrong <Length>, use the END at the end of the file
+            if end is None and at_end:
+                end = buffer.rfind(b'END', max(len(buffer) - hold, 0))
+                if end < 0:
+                    end = len(buffer)
+            finished = end is not None
+            if finished:
+                available = end
+            else:
+                available = len(buffer) - hold
+                if length is not None:
+                    available = min(available, length - consumed)
+            if start_time is None:
+                if available < LPC_RECORD_OFFSET:
+                    if finished:
+                        return
+                    continue
+                start_time = struct.unpack_from('>I', buffer, 0)[0]
+                buffer = buffer[LPC_RECORD_OFFSET:]
+                consumed += LPC_RECORD_OFFSET
+                available -= LPC_RECORD_OFFSET
+                if finished:
+                    end -= LPC_RECORD_OFFSET
+            n = min(max(available, 0) // LPC_RECORD_SIZE, batch_records)
+            if n == 0:
+                if finished:
+                    return
+                continue
+            records = np.frombuffer(buffer, dtype = LPC_RECORD_DTYPE, count = n).copy()
+            buffer = buffer[n * LPC_RECORD_SIZE:]
+            consumed += n * LPC_RECORD_SIZE
+            if finished:
+                end -= n * LPC_RECORD_SIZE
+            good = validateLPCrecords(records, start_time)[0]
+            if not good.all():
+                records = records[good]
+            if len(records) > 0:
+                yield records
+
+def iter_flight(flight_dir, pattern = '*.gz', batch_records = 4096):
+    """
+    Yield (filename, batch) for every TM file in flight_dir in filename order, where
+    batch is a float array of records with the csv columns
+    """
+    for tm_path in sorted(glob.glob(os.path.join(flight_dir, pattern))):
+        for records in iter_records(tm_path, batch_records):
+            yield tm_path, LPCrecordArray(records)
+
+def skip_first_records(batches, n = 3):
+    """
+    Drop the first n records of every file, as the master and mean files do
+    """
+    current = None
+    left = 0
+    for filename, batch in batches:
+        if filename != current:
+            current = filename
+            left = n
+        if left > 0:
+            dropped = min(left, len(batch))
+            batch = batch[dropped:]
+            left -= dropped
+        if len(batch) > 0:
+            yield filename, batch
+
+def csv_header_text():
+    """
+    The two header lines of the master and mean files, as written by writeLPCcsv
+    """
+    text = io.StringIO()
+    writer = csv.writer(text, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+    writer.writerow(LPC_HK_FIELDS + list(map(str,LPC_DIAMS)))
+    writer.writerow(LPC_HK_UNITS + ['[diam >nm]']*len(LPC_DIAMS))
+    return text.getvalue()
+
+class MasterCSVSink:
+    def __init__(self, master_file_name):
+        with open(master_file_name, 'w', newline = '') as outfile:
+            outfile.write(csv_header_text())
+        self.file = open(master_file_name, 'ab')
+
+    def write(self, filename, batch):
+        np.savetxt(self.file, batch, delimiter = ",")
+
+    def close(self):
+        self.file.close()
+
+class MeanSink:
+    def __init__(self, mean_file_name, stats_file_name = None, time_offset = MST_TO_UTC):
+        self.mean_file_name = mean_file_name
+        self.stats_file_name = stats_file_name
+        self.time_offset = time_offset
+        self.current = None
+        self.accumulator = None
+        with open(mean_file_name, 'w', newline = '') as outfile:
+            outfile.write(csv_header_text())
+        if stats_file_name is not None:
+            with open(stats_file_name, 'w', newline = '') as outfile:
+                csv.writer(outfile, delimiter=',').writerow(stats_header(LPC_HK_FIELDS + list(map(str,LPC_DIAMS))))
+
+    def write(self, filename, batch):
+        if filename != self.current:
+            self.finish_file()
+            self.current = filename
+            self.accumulator = MeanAccumulator(batch.shape[1])
+        self.accumulator.add(batch)
+
+    def finish_file(self):
+        if self.accumulator is None:
+            return
+        write_mean(self.accumulator, self.current, self.mean_file_name, None, self.stats_file_name, self.time_offset)
+        self.accumulator = None
+
+    def close(self):
+        self.finish_file()
+
+class ColumnarSink:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        create_store(store_dir, MASTER_COLUMNS, csv_header_text())
+        self.writer = StoreWriter(store_dir)
+
+    def write(self, filename, batch):
+        self.writer.append(filename, batch, extend = True)
+
+    def close(self):
+        self.writer.close()
+
+def run_sinks(batches, sinks):
+    """
+    Feed every (filename, batch) pair to each sink, then close the sinks.
+    Returns the number of records processed.
+    """
+    n_records = 0
+    try:
+        for filename, batch in batches:
+            n_records += len(batch)
+            for sink in sinks:
+                sink.write(filename, batch)
+    finally:
+        for sink in sinks:
+            sink.close()
+    return n_records
+
+def stream_flight(flight_dir, mean_file_name, master_file_name, store_dir = None, batch_records = 4096,
+                  stats_file_name = None, time_offset = MST_TO_UTC):
+    """
+    Write the master and mean csv files (and optionally a columnar store of the
+    master data and a statistics file) of a flight directly from its TM files
+    """
+    sinks = [MasterCSVSink(master_file_name), MeanSink(mean_file_name, stats_file_name, time_offset)]
+    if store_dir is not None:
+        sinks.append(ColumnarSink(store_dir))
+    return run_sinks(skip_first_records(iter_flight(flight_dir, batch_records = batch_records)), sinks)
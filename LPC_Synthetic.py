@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic LPC TM files for testing and benchmarking.
+
+Writes gzipped TM files laid out like the ones on the CCMz: an XML header with
+the message ID and state messages, then START, the binary section (36 byte
+header starting with the start time, an unused record slot and 96 byte
+records) and END.  The housekeeping values are raw counts around typical
+flight values and the bins fall off with size like a real size distribution.
+
+Usage: python3 LPC_Synthetic.py output_dir [n_files] [n_records]
+"""
+
+import os
+import sys
+import gzip
+import struct
+import numpy as np
+from readLPCXML import LPC_RECORD_SIZE
+
+#Typical raw HK values (words 2-15) and their spread: currents in mA, voltages and flow in mV/mSLPM, temperatures in cK
+HK_TYPICAL = np.array([350, 350, 100, 50, 12000, 3300, 15000, 1200, 5000, 29315, 29315, 29815, 30315, 21315])
+HK_SPREAD = np.array([20, 20, 30, 5, 50, 20, 300, 100, 100, 300, 300, 200, 200, 500])
+#Mean counts per record in each of the 16 high gain and 16 low gain bins
+BIN_COUNTS = np.concatenate((2000.0 * np.exp(-np.arange(16) / 2.5), 50.0 * np.exp(-np.arange(16) / 2.0)))
+
+
+def make_records(n_records, start_time, rng, dt = 10):
+    """
+    Return an (n_records x 48) uint16 array of raw records starting at start_time
+    with one record every dt seconds
+    """
+    records = np.zeros((n_records, 48), dtype = np.uint16)
+    records[:, :32] = np.minimum(rng.poisson(BIN_COUNTS, size = (n_records, 32)), 65535)
+    time = start_time + dt * np.arange(n_records)
+    records[:, 32] = time % 65535  #the decoder rebuilds time_t as HK0 + HK1*65535
+    records[:, 33] = time // 65535
+    hk = rng.normal(HK_TYPICAL, HK_SPREAD, size = (n_records, len(HK_TYPICAL)))
+    records[:, 34:] = np.clip(np.round(hk), 0, 65535)
+    return records
+
+def tm_bytes(msg_id, start_time, records, state_message = 'FL: Measuring'):
+    """
+    Return the contents of one TM file holding the records
+    """
+    binary = struct.pack('>I', start_time) + bytes(32) + bytes(LPC_RECORD_SIZE) + records.astype('>u2').tobytes()
+    xml = ('<TM>\n<Msg>' + str(msg_id) + '</Msg>\n<Inst>LPC</Inst>\n<Length>' + str(len(binary)) + '</Length>\n'
+           '<StateFlag1>FINE</StateFlag1>\n<StateMess1>' + state_message + '</StateMess1>\n'
+           '<StateFlag2>FINE</StateFlag2>\n<StateMess2></StateMess2>\n'
+           '<StateFlag3>FINE</StateFlag3>\n<StateMess3></StateMess3>\n</TM>\n<CRC>0</CRC>\n')
+    return xml.encode() + b'START' + binary + b'END'
+
+def make_tm_file(filename, msg_id, start_time, n_records, rng):
+    """
+    Write one gzipped synthetic TM file
+    """
+    with gzip.open(filename, 'wb') as f:
+        f.write(tm_bytes(msg_id, start_time, make_records(n_records, start_time, rng)))
+    return filename
+
+def make_flight(output_dir, n_files = 10, n_records = 360, flight = 'ST2_C0_00_TEST',
+                start_time = 1600000000, dt = 10, seed = 0):
+    """
+    Write n_files TM files of n_records records each, back to back in time, to
+    output_dir.  Returns the list of files.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    rng = np.random.default_rng(seed)
+    files = []
+    for k in range(n_files):
+        t0 = start_time + k * n_records * dt
+        filename = os.path.join(output_dir, flight + '_LPC_TM_' + '{:05d}'.format(k) + '.dat.gz')
+        files.append(make_tm_file(filename, k, t0, n_records, rng))
+    return files
+
+def main():
+    if len(sys.argv) < 2:
+        print('Usage: python3 LPC_Synthetic.py output_dir [n_files] [n_records]')
+        return
+    n_files = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    n_records = int(sys.argv[3]) if len(sys.argv) > 3 else 360
+    files = make_flight(sys.argv[1], n_files, n_records)
+    print('Wrote ' + str(len(files)) + ' TM files to ' + sys.argv[1])
+
+if __name__ == "__main__":
+    main()
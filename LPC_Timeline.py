@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Whole-flight timeline for LPC_QuickPlot.
+
+The records of a dataset are reduced once to a pyramid of resampled products
+(see LPC_Resample): 60 s bins, then 4, 16, 64 ... times longer until the
+coarsest level has fewer than TIMELINE_MAX_POINTS bins.  The levels are kept as
+columnar stores in <dataset store>_timeline and rebuilt when the dataset
+changes.  TimelineView draws a time x diameter heatmap and housekeeping traces
+(mean, with the min to max range shaded) from the finest level that has at most
+TIMELINE_MAX_POINTS bins in the visible time range, or from the records
+themselves once zoomed in that far, so zooming and panning only ever draw a
+screen's worth of points.  Clicking in the timeline moves the scan slider of
+quick_plot to the closest record:
+
+  fig = quick_plot(LPC, dt = dt)
+  view = TimelineView(LPC, fig.widgets[0], dt)
+"""
+
+import os
+import json
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
+from datetime import datetime
+from datetime import timezone
+from matplotlib.colors import LogNorm
+from LPC_Columnar import *
+from LPC_Query import LPCQuery
+from LPC_Resample import resample, coarsen, write_product, sorted_good_rows
+from LPC_SizeDist import size_distribution, sample_interval, LPC_BIN_LOWER, LPC_BIN_UPPER, LPC_VALID_BINS
+
+TIMELINE_BASE_INTERVAL = 60
+TIMELINE_FACTOR = 4
+TIMELINE_MAX_POINTS = 2000
+CHUNK_ROWS = 1 << 20 #records resampled at a time while building the pyramid
+#(y label, HK columns) of each trace panel below the heatmap
+TIMELINE_TRACES = [('Temperature [C]', ['Pump1_T', 'Pump2_T', 'Laser_T', 'Inlet_T']), ('Flow [SLPM]', ['Flow'])]
+
+
+def timeline_dir(store_dir):
+    return os.path.normpath(store_dir) + '_timeline'
+
+def level_store_name(directory, interval):
+    return os.path.join(directory, str(int(interval)) + 's')
+
+def build_pyramid(columns, dt = None, base_interval = TIMELINE_BASE_INTERVAL, factor = TIMELINE_FACTOR,
+                  max_points = TIMELINE_MAX_POINTS):
+    """
+    Resample a dict of dataset columns to base_interval, CHUNK_ROWS records at a
+    time, then coarsen by factor until a level has at most max_points bins.
+    Returns a list of (interval, product).
+    """
+    rows = sorted_good_rows(columns)
+    if dt is None:
+        dt = sample_interval(np.asarray(columns['Time'])[rows])
+    parts = [resample(columns, base_interval, dt, rows[i:i+CHUNK_ROWS]) for i in range(0, len(rows), CHUNK_ROWS)]
+    if len(parts) == 0:
+        parts = [resample(columns, base_interval, dt, rows)]
+    level = coarsen(dict((name, np.concatenate([part[name] for part in parts])) for name in parts[0]), base_interval)
+    levels = [(base_interval, level)]
+    interval = base_interval
+    while len(level['Time']) > max_points:
+        interval *= factor
+        level = coarsen(level, interval)
+        levels.append((interval, level))
+    return levels
+
+def load_pyramid(store_dir, dt = None):
+    """
+    The levels of the timeline of a dataset store as a list of (interval, columns),
+    built the first time and whenever the store is newer than the timeline
+    """
+    directory = timeline_dir(store_dir)
+    levels_file = os.path.join(directory, 'levels.json')
+    if not os.path.exists(levels_file) or os.path.getmtime(levels_file) < os.path.getmtime(os.path.join(store_dir, 'index.json')):
+        print('Building timeline of ' + store_dir + ' in ' + directory)
+        levels = build_pyramid(load_store(store_dir), dt)
+        for interval, product in levels:
+            write_product(product, level_store_name(directory, interval), store_dir)
+        with open(levels_file + '.tmp', 'w') as f:
+            json.dump([interval for interval, product in levels], f)
+        os.replace(levels_file + '.tmp', levels_file)
+    with open(levels_file) as f:
+        intervals = json.load(f)
+    return [(interval, load_store(level_store_name(directory, interval))) for interval in intervals]
+
+def utc_label(t, pos = None):
+    return datetime.fromtimestamp(t, tz = timezone.utc).strftime('%m/%d %H:%M')
+
+class TimelineView:
+    """
+    Heatmap and housekeeping traces of a whole LPCDataset that redraw from the
+    level of the pyramid that suits the visible time range.  With the sample time
+    dt the heatmap shows dN/dlogD, otherwise the mean counts per record.  Clicking
+    moves slider (the scan slider of quick_plot) to the closest record.
+    """
+    def __init__(self, LPC, slider = None, dt = None, max_points = TIMELINE_MAX_POINTS):
+        self.LPC = LPC
+        self.slider = slider
+        self.dt = dt
+        self.max_points = max_points
+        self.levels = load_pyramid(LPC.store_dir, dt)
+        self.query = LPCQuery(LPC.store_dir)
+        self.trace_names = [name for label, names in TIMELINE_TRACES for name in names]
+        if 'Flow' not in self.trace_names:
+            self.trace_names.append('Flow')  #needed for the dN/dlogD of the records
+
+        self.fig, axes = plt.subplots(1 + len(TIMELINE_TRACES), 1, sharex = True, figsize = (11, 8),
+                                      gridspec_kw = {'height_ratios': [2] + [1] * len(TIMELINE_TRACES)})
+        self.heat_ax = axes[0]
+        self.trace_axes = axes[1:]
+        self.heat_ax.set_yscale('log')
+        self.heat_ax.set_ylabel('Diameter [nm]')
+        for ax, (label, names) in zip(self.trace_axes, TIMELINE_TRACES):
+            ax.set_ylabel(label)
+        self.trace_axes[-1].set_xlabel('Time [UTC]')
+        self.trace_axes[-1].xaxis.set_major_formatter(ticker.FuncFormatter(utc_label))
+        self.edges = np.append(LPC_BIN_LOWER[LPC_VALID_BINS], LPC_BIN_UPPER[LPC_VALID_BINS][-1])
+
+        interval, coarsest = self.levels[-1]
+        heat = self.heat_values(coarsest)
+        positive = heat[heat > 0]
+        self.norm = LogNorm(*np.nanpercentile(positive, [1, 99.9])) if len(positive) > 0 else LogNorm(1e-3, 1)
+        self.mesh = None
+        self.colorbar = None
+        self.artists = []
+        self.cursors = [ax.axvline(np.nan, color = 'k', lw = 1) for ax in axes]
+        self.drawing = False
+
+        base_interval, finest = self.levels[0]
+        t0 = float(finest['Time'][0]) if len(finest['Time']) > 0 else 0.0
+        t1 = float(finest['Time'][-1]) + base_interval if len(finest['Time']) > 0 else 1.0
+        self.draw(t0, t1)
+        self.heat_ax.set_xlim(t0, t1)
+        self.heat_ax.callbacks.connect('xlim_changed', self.on_xlim)
+        self.fig.canvas.mpl_connect('button_press_event', self.on_click)
+        if slider is not None:
+            slider.on_changed(self.on_scan)
+            self.on_scan(slider.val)
+
+    def heat_values(self, data, flow = None):
+        """
+        What the heatmap shows for the rows of a level (or the records, with their flow)
+        """
+        if self.dt is None:
+            return np.asarray(data['Bins'])[:, LPC_VALID_BINS]
+        if flow is not None:
+            return size_distribution(data['Bins'], flow, dt = self.dt)['dNdlogD'][:, LPC_VALID_BINS]
+        return np.asarray(data['dNdlogD'])[:, LPC_VALID_BINS]
+
+    def level_for(self, t0, t1):
+        """
+        (interval, level) of the finest level with at most max_points bins between t0
+        and t1, or (dt, None) when the records themselves are few enough
+        """
+        span = max(t1 - t0, 1e-9)
+        if self.dt is not None and span / self.dt <= self.max_points:
+            return self.dt, None
+        for interval, level in self.levels:
+            if span / interval <= self.max_points:
+                return interval, level
+        return self.levels[-1]
+
+    def view_data(self, t0, t1):
+        """
+        Start times, bin width, heatmap values, (mean, min, max) of each trace between
+        t0 and t1 and whether they are the records themselves
+        """
+        interval, level = self.level_for(t0, t1)
+        if level is None:
+            data = self.query.time_range(t0 - interval, t1 + interval, ['Time', 'Bins'] + self.trace_names)
+            good = data['Flow'] >= 0.5
+            data = dict((name, values[good]) for name, values in data.items())
+            heat = self.heat_values(data, data['Flow'])
+            traces = dict((name, (data[name], data[name], data[name])) for name in self.trace_names)
+            return data['Time'], interval, heat, traces, True
+        time = level['Time']
+        first = max(np.searchsorted(time, t0 - interval) - 1, 0)
+        last = np.searchsorted(time, t1 + interval) + 1
+        rows = slice(first, last)
+        traces = dict((name, (level[name][rows], level[name + '_min'][rows], level[name + '_max'][rows]))
+                      for name in self.trace_names)
+        heat = self.heat_values(dict(Bins = level['Bins'][rows], dNdlogD = level['dNdlogD'][rows]))
+        return np.asarray(time[rows]), interval, heat, traces, False
+
+    def draw(self, t0, t1):
+        self.drawing = True
+        time, interval, heat, traces, records = self.view_data(t0, t1)
+        if self.mesh is not None:
+            self.mesh.remove()
+        for artist in self.artists:
+            artist.remove()
+        self.artists = []
+        if len(time) > 0:
+            self.mesh = self.heat_ax.pcolormesh(np.append(time, time[-1] + interval), self.edges, np.asarray(heat).T,
+                                                norm = self.norm, shading = 'flat')
+        else:
+            self.mesh = self.heat_ax.pcolormesh(np.array([t0, t1]), self.edges, np.full((len(self.edges)-1, 1), np.nan), norm = self.norm)
+        if self.colorbar is None:
+            self.colorbar = self.fig.colorbar(self.mesh, ax = [self.heat_ax] + list(self.trace_axes), label = 'Counts' if self.dt is None else 'dN/dlogD [#/cc]')
+        self.heat_ax.set_ylim(self.edges[0], self.edges[-1])
+        self.heat_ax.set_title(('records' if records else str(int(interval)) + ' s bins') + ', ' + str(len(time)) + ' shown')
+
+        centers = np.asarray(time) + (0 if records else interval / 2)
+        for ax, (label, names) in zip(self.trace_axes, TIMELINE_TRACES):
+            lows = []
+            highs = []
+            for k, name in enumerate(names):
+                mean, low, high = [np.asarray(v) for v in traces[name]]
+                line, = ax.plot(centers, mean, 'C' + str(k), lw = 1, label = name)
+                self.artists.append(line)
+                if not records:
+                    self.artists.append(ax.fill_between(centers, low, high, color = line.get_color(), alpha = 0.25, lw = 0))
+                lows.append(low)
+                highs.append(high)
+            values = np.concatenate(lows + highs) if len(centers) > 0 else np.zeros(0)
+            values = values[np.isfinite(values)]
+            if len(values) > 0:
+                margin = max(0.05 * (values.max() - values.min()), 1e-3)
+                ax.set_ylim(values.min() - margin, values.max() + margin)
+            if len(names) > 1 and ax.get_legend() is None:
+                ax.legend(loc = 'upper left', fontsize = 'small')
+        self.heat_ax.set_xlim(t0, t1)
+        self.drawing = False
+
+    def on_xlim(self, ax):
+        if not self.drawing:
+            t0, t1 = ax.get_xlim()
+            self.draw(t0, t1)
+            self.fig.canvas.draw_idle()
+
+    def on_click(self, event):
+        toolbar = self.fig.canvas.toolbar
+        if event.inaxes is None or event.button != 1 or self.slider is None or (toolbar is not None and toolbar.mode != ''):
+            return
+        row = self.query.row_at(event.xdata)
+        if row is not None:
+            self.slider.set_val(row)
+
+    def on_scan(self, val):
+        i = min(max(int(val), 0), len(self.LPC) - 1)
+        t = float(self.LPC.column('Time')[i])
+        for cursor in self.cursors:
+            cursor.set_xdata([t, t])
+        self.fig.canvas.draw_idle()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Building blocks of the GetLPC watch mode.
+
+watch_loop polls for new files on an interval, backing off when a poll fails,
+and hands every batch of new files to a ProcessingQueue.  The queue processes
+the batches one at a time on its own thread, so the next poll (and download)
+runs while the previous batch is decoded and added to the master files.
+The StageMetrics of LPC_Instrument collect how long each stage takes and the
+end-to-end latency of each file, from the time it appeared on the CCMz (its
+modification time) to the time it is processed.
+"""
+
+import time
+import queue
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class Backoff:
+    """
+    Poll interval that doubles after each failed poll, up to max_interval, and
+    goes back to interval after a successful one
+    """
+    def __init__(self, interval, max_interval, factor = 2):
+        self.interval = interval
+        self.max_interval = max_interval
+        self.factor = factor
+        self.delay = interval
+
+    def success(self):
+        self.delay = self.interval
+        return self.delay
+
+    def failure(self):
+        self.delay = min(self.delay * self.factor, self.max_interval)
+        return self.delay
+
+class PollError(Exception):
+    """
+    Raised by a poll that failed part way, with the jobs it collected before and
+    after the failure so they are still processed
+    """
+    def __init__(self, error, jobs):
+        Exception.__init__(self, error)
+        self.jobs = jobs
+
+class ProcessingQueue:
+    """
+    Runs process(*job) for every job put on the queue, in order, on one background
+    thread.  An exception in process is logged and the next job goes on.  With
+    max_pending put blocks while that many jobs are waiting.
+    """
+    def __init__(self, process, metrics = None, max_pending = 0):
+        self.process = process
+        self.metrics = metrics
+        self.jobs = queue.Queue(max_pending)
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def put(self, *job):
+        self.jobs.put((time.time(), job))
+
+    def run(self):
+        while True:
+            queued, job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+            if self.metrics is not None:
+                self.metrics.record('queue_wait', time.time() - queued)
+            try:
+                self.process(*job)
+            except Exception as e:
+                log.error('processing failed job=%s error=%r', job, e)
+            self.jobs.task_done()
+
+    def pending(self):
+        return self.jobs.qsize()
+
+    def join(self):
+        """
+        Wait until every job put so far is processed
+        """
+        self.jobs.join()
+
+    def close(self):
+        self.jobs.put((time.time(), None))
+        self.thread.join()
+
+def watch_loop(poll, processing, backoff, metrics = None, metrics_file = None, max_polls = None, sleep = time.sleep):
+    """
+    Call poll() every backoff interval until max_polls polls (forever if None).
+    poll returns a list of jobs (tuples of arguments for the processing queue) and
+    raises if the CCMz cannot be reached, in which case the interval is backed off.
+    The jobs of a PollError are still queued.
+    """
+    n_polls = 0
+    while max_polls is None or n_polls < max_polls:
+        n_polls += 1
+        try:
+            if metrics is not None:
+                with metrics.stage('poll'):
+                    jobs = poll()
+            else:
+                jobs = poll()
+            delay = backoff.success()
+        except Exception as e:
+            jobs = e.jobs if isinstance(e, PollError) else []
+            delay = backoff.failure()
+            log.warning('poll failed error=%r next_try_s=%s', e, delay)
+        for job in jobs:
+            processing.put(*job)
+        if metrics is not None:
+            if metrics_file is not None:
+                metrics.write(metrics_file)
+            log.info('poll=%d new_batches=%d queued=%d stages: %s', n_polls, len(jobs), processing.pending(), metrics.report())
+        if max_polls is None or n_polls < max_polls:
+            sleep(delay)
+    return n_polls
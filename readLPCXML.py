@@ -9,206 +9,314 @@ Created on Mon Jul 29 09:40:57 2019
 #Python code to illustrate parsing of XML files 
 # importing the required modules 
 import csv 
+import re
 import xml.etree.ElementTree as ET 
 import struct
 import os
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import gzip
+import logging
 from datetime import datetime
 from datetime import timezone
+from LPC_Instrument import metrics
 
+log = logging.getLogger(__name__)
 
-def readTMfile(TMfile,lines):
-    with open(TMfile, 'rb') as TM_file:
-        header = [next(TM_file).decode() for x in range(lines)]
-        TM_file.readline()
-        data = TM_file.readlines()
 
-    return ''.join(header), b''.join(data)
-          
-def parseXML(xmlstring): 
-  
-    # create element tree object 
-    root = ET.fromstring(xmlstring) 
-    
-    #create a dictionary to store the tags
+#Tags of the XML header kept in a header record (see headerRecord) and their types.  The
+#message ID stays text so its leading zeros are kept.
+LPC_HEADER_SCHEMA = [('Msg', str), ('Inst', str), ('Length', int),
+                     ('StateFlag1', str), ('StateMess1', str), ('StateFlag2', str), ('StateMess2', str),
+                     ('StateFlag3', str), ('StateMess3', str), ('CRC', int)]
+
+def parseHeader(prefix):
+    ''' Parse the XML header of a TM (the bytes before START) with an incremental pull
+    parser.  Returns a dict of the text of every leaf tag; a repeated tag keeps its first
+    value and the later ones are listed in 'Repeated' as (tag, text) tuples.  A damaged
+    header gives the tags before the damage. '''
     
+    parser = ET.XMLPullParser(events=('end',))
     XMLdict = dict()
-  
-    for child in root:
-        value = root.find(child.tag).text
-        XMLdict[child.tag] = value
-      
-    # return the dict
+    repeated = []
+    try:
+        parser.feed(b'<TMheader>')
+        parser.feed(re.sub(rb'<\?xml[^>]*\?>', b'', bytes(prefix)))  #drop any XML declaration
+        parser.feed(b'</TMheader>')
+        for event, element in parser.read_events():
+            if len(element) == 0 and element.tag != 'TMheader':
+                if element.tag in XMLdict:
+                    repeated.append((element.tag, element.text))
+                else:
+                    XMLdict[element.tag] = element.text
+    except ET.ParseError:
+        pass
+    if repeated:
+        XMLdict['Repeated'] = repeated
     return XMLdict
-         
-def parseLCPdatatoCSV(InputFile,OutputFile):
-    ''' This function parses the input binary file to a human readable csv file of the same name with a
-    .csv extension'''    
+
+def headerRecord(XMLdict, StartTime=None):
+    ''' Typed header record from a dict returned by parseHeader: the LPC_HEADER_SCHEMA
+    tags converted to their types (None if missing or not valid), the start time from
+    the binary header and the text of any other tags in 'Extra' '''
+    
+    record = dict()
+    for tag, kind in LPC_HEADER_SCHEMA:
+        value = XMLdict.get(tag)
+        if value is not None and kind is not str:
+            try:
+                value = kind(value.strip())
+            except ValueError:
+                value = None
+        record[tag] = value
+    record['StartTime'] = StartTime
+    names = set(tag for tag, kind in LPC_HEADER_SCHEMA)
+    record['Extra'] = dict((tag, value) for tag, value in XMLdict.items() if tag not in names)
+    return record
+
+def readTMHeader(InputFile, block_size=1 << 14):
+    ''' Read only the XML header of a gzipped TM file and the start time from its binary
+    header, decompressing up to just past START.  Returns the header record (see
+    headerRecord). '''
     
-    #OutputFile =  os.path.splitext( InputFile)[0] + '.csv'
-    #print('parseLPC Output File:')
-    #print(OutputFile)
     with gzip.open(InputFile, "rb") as binary_file:
-        bindata = binary_file.read()  # Read the whole file at once
+        bindata = b''
+        while True:
+            block = binary_file.read(block_size)
+            bindata += block
+            header_end = bindata.find(b'</CRC>')
+            marker = bindata.find(b'START', header_end) if header_end >= 0 else -1
+            if len(block) == 0 or (marker >= 0 and len(bindata) >= marker + 9):
+                break
+    marker = findSectionStart(bindata)
+    if marker < 0:
+        return headerRecord(parseHeader(bindata))
+    StartTime = struct.unpack_from('>I', bindata, marker + 5)[0] if len(bindata) >= marker + 9 else None
+    return headerRecord(parseHeader(bindata[:marker]), StartTime)
+         
+#LPC bins - each number is the left end of the bins in nm.   The first bin has minimal sensitivity
+LPC_DIAMS = [275,300,325,350,375,400,450,500,550,600,650,700,750,800,900,1000,1200,1400,1600,1800,2000,2500,3000,3500,4000,6000,8000,10000,13000,16000,24000,24000]
+
+#Names and units of the 15 scaled housekeeping columns at the start of each csv row
+LPC_HK_FIELDS = ['Time', 'Pump1_I','Pump2_I','Heater_I','PHA_I', 'PHA_12V','PHA_3V3',
+                 'Input_V', 'Flow', 'Motor_V', 'Pump1_T', 'Pump2_T',
+                 'Laser_T', 'DC-DC_T', 'Inlet_T']
+LPC_HK_UNITS = ['[Unix Time]', '[mA]','[mA]','[mA]','[mA]', '[V]','[V]',
+                '[V]', '[SLPM]', '[V]', '[C]', '[C]',
+                '[C]', '[C]', '[C]']
+
+#Each 96 byte record is 16 high gain bins, 16 low gain bins and 16 HK words, all big-endian uint16
+LPC_RECORD_SIZE = 96
+LPC_RECORD_DTYPE = np.dtype([('HG', '>u2', (16,)), ('LG', '>u2', (16,)), ('HK', '>u2', (16,))])
+#Records start after the 36 byte binary header, the first record slot is not used
+LPC_RECORD_OFFSET = 36 + LPC_RECORD_SIZE
+#Bump when the decoding of the binary section changes (LPC_DECODER_VERSION) or the HK
+#scaling in scaleHK changes (LPC_HK_VERSION), cached decoded records depend on them
+LPC_DECODER_VERSION = 3
+LPC_HK_VERSION = 1
+#A final END may be followed by this many bytes (e.g. a newline) before the end of the file
+LPC_END_SLACK = 16
+#Records whose time is further than this from the start time in the binary header are dropped
+LPC_MAX_TIME_OFFSET = 86400
+
+def findSectionStart(bindata):
+    ''' Position of the START that opens the binary section: the first one after the
+    XML header (after </CRC>, or </TM> if there is no CRC), or -1 if there is none '''
+    
+    header_end = bindata.find(b'</CRC>')
+    if header_end < 0:
+        header_end = max(bindata.find(b'</TM>'), 0)
+    return bindata.find(b'START', header_end)
+
+def headerLength(header):
+    ''' The <Length> of the binary section given in the XML header, or None '''
+    
+    length = findTag(header, b'Length')
+    if length is None or not length.strip().isdigit():
+        return None
+    return int(length)
+
+def frameTM(bindata):
+    ''' Locate the binary section of a TM file.  Returns (start, end, framing) where
+    bindata[start:end] is the section and framing tells how its end was found:
+    'length' - the END right after the <Length> bytes given in the XML header
+    'end'    - the END at the end of the file (the <Length> is missing or wrong)
+    'truncated' - there is no final END, the section runs to the end of the file
+    'missing'   - there is no START, the section is empty
+    An END inside the records does not end the section. '''
+    
+    marker = findSectionStart(bindata)
+    if marker < 0:
+        return len(bindata), len(bindata), 'missing'
+    start = marker + 5
+    length = headerLength(bindata[:marker])
+    if length is not None and bindata[start+length:start+length+3] == b'END':
+        return start, start + length, 'length'
+    end = bindata.rfind(b'END', max(len(bindata) - LPC_END_SLACK - 3, start))
+    if end >= 0:
+        return start, end, 'end'
+    return start, len(bindata), 'truncated'
+
+def decodeLPCrecords(data):
+    ''' Decode the binary section of a TM (the bytes between START and END) into a 
+    structured array of raw records with 'HG', 'LG' and 'HK' uint16 fields.  Only
+    whole records are decoded, the bytes of a cut off last record are ignored. '''
+    
+    n_records = max((len(data) - LPC_RECORD_OFFSET) // LPC_RECORD_SIZE, 0)
+    if n_records == 0:
+        return np.zeros(0, dtype=LPC_RECORD_DTYPE)
+    
+    return np.frombuffer(data, dtype=LPC_RECORD_DTYPE, count=n_records, offset=LPC_RECORD_OFFSET)
+
+def validateLPCrecords(records, StartTime):
+    ''' Check a record array, returns a boolean array that is True for the good records,
+    the number of records with a time more than LPC_MAX_TIME_OFFSET from StartTime, and
+    the number of fill records (all HK words 0xFFFF, or the whole record 0 or 0xFFFF) '''
+    
+    HK = records['HK']
+    sentinel = np.all(HK == 0xFFFF, axis=1)
+    sentinel |= np.all(HK == 0, axis=1) & np.all(records['HG'] == 0, axis=1) & np.all(records['LG'] == 0, axis=1)
+    sentinel |= np.all(records['HG'] == 0xFFFF, axis=1) & np.all(records['LG'] == 0xFFFF, axis=1)
+    time = HK[:,0].astype(np.int64) + HK[:,1].astype(np.int64)*65535
+    bad_time = np.abs(time - int(StartTime)) > LPC_MAX_TIME_OFFSET
+    bad_time &= ~sentinel
+    return ~(sentinel | bad_time), int(bad_time.sum()), int(sentinel.sum())
+
+#Scaling of the raw HK words 2 to 15 (the csv columns after Time): value = raw / divisor + offset
+LPC_HK_DIVISOR = [1]*4 + [1000.0]*5 + [100.0]*5  # currents in mA, voltages in V and flow in SLPM, temperatures
+LPC_HK_OFFSET = [0]*9 + [-273.15]*5  # temperatures in C
+
+def scaleHKcolumn(raw, k):
+    ''' Scale raw HK word k+2 (an integer array), the currents stay integer '''
+    
+    if LPC_HK_DIVISOR[k] == 1 and LPC_HK_OFFSET[k] == 0:
+        return raw
+    if LPC_HK_OFFSET[k] == 0:
+        return raw / LPC_HK_DIVISOR[k]
+    return raw / LPC_HK_DIVISOR[k] + LPC_HK_OFFSET[k]
+
+def scaleHK(records):
+    ''' Apply the housekeeping scaling to a record array, returns a list of the 15 
+    HK columns in csv order.  Time and currents stay integer, the rest are floats '''
+    
+    HKRaw = records['HK'].astype(np.int64)
+    HKData = [HKRaw[:,0] + HKRaw[:,1]*65535]  # 16 LSB of time_t
+    HKData += [scaleHKcolumn(HKRaw[:,x+2], x) for x in range(14)]
+    
+    return HKData
+
+def LPCrecordArray(records, HKData=None):
+    ''' Convert a record array to a float array with the same 47 columns as the csv rows.
+    HKData is the output of scaleHK if it is already known '''
+    
+    if HKData is None:
+        HKData = scaleHK(records)
+    return np.column_stack(list(HKData) + [records['HG'], records['LG']]).astype(np.float64)
+
+def LPCrecordRows(records, HKData=None):
+    ''' Convert a record array to a list of csv rows: 15 scaled HK values then the 32 bins.
+    HKData is the output of scaleHK if it is already known '''
+    
+    if HKData is None:
+        HKData = scaleHK(records)
+    HKRows = zip(*[column.tolist() for column in HKData])
+    BinRows = np.concatenate((records['HG'], records['LG']), axis=1).tolist()
+    
+    return [list(hk) + bins for hk, bins in zip(HKRows, BinRows)]
+
+def findTag(bindata, tag):
+    ''' Return the text of the first <tag>...</tag> in bindata without parsing the XML,
+    or None if the tag is not there '''
+    start = bindata.find(b'<' + tag + b'>')
+    end = bindata.find(b'</' + tag + b'>')
+    if start < 0 or end < start:
+        return None
+    return bytes(bindata[start+len(tag)+2:end]).decode(errors='replace')
+
+def readTM(InputFile):
+    ''' Decompress a gzipped TM file once and return a dict with the parsed XML header
+    ('XML', see parseHeader), the typed header record ('header'), the message ID ('MsgID'), the first state message ('StateMess1'), the 
+    binary section ('data', a memoryview into the decompressed file), the decoded
+    record array ('records', a view of the same buffer without the records that fail
+    validateLPCrecords) and the quality of the file ('quality', see frameTM) '''
+    
+    with metrics.stage('gzip'):
+        with gzip.open(InputFile, "rb") as binary_file:
+            bindata = binary_file.read()  # Read the whole file at once
+    metrics.count('files')
+    metrics.count('bytes_compressed', os.path.getsize(InputFile))
+    metrics.count('bytes', len(bindata))
     
-    start = bindata.find(b'START') + 5  # Find the 'START' string that mark the start of the binary section
-    end = bindata.find(b'END') #Find the end of the binary section
-    #print('START found at: ' + str(start))
-    #print('END found at: ' + str(end))
-    data = bindata[start:end] #Pull the binary section from the XML packet
+    start, end, framing = frameTM(bindata)
+    data = memoryview(bindata)[start:end] #Pull the binary section from the XML packet without copying
     
-    #LPC bins - each number is the left end of the bins in nm.   The first bin has minimal sensitivity
-    diams = [275,300,325,350,375,400,450,500,550,600,650,700,750,800,900,1000,1200,1400,1600,1800,2000,2500,3000,3500,4000,6000,8000,10000,13000,16000,24000,24000]
-    bin_header = list(map(str,diams))
+    with metrics.stage('xml'):
+        XMLdict = parseHeader(memoryview(bindata)[:max(start-5,0)])
     
-    with open(OutputFile, mode='w') as out_file:
+    TM = dict()
+    TM['filename'] = InputFile
+    TM['XML'] = XMLdict
+    TM['header'] = headerRecord(XMLdict, struct.unpack_from('>I',data,0)[0] if len(data) >= 4 else None)
+    TM['MsgID'] = XMLdict.get('Msg') or findTag(bindata, b'Msg')
+    TM['StateMess1'] = XMLdict.get('StateMess1') or findTag(bindata, b'StateMess1')
+    TM['data'] = data
+    with metrics.stage('decode'):
+        records = decodeLPCrecords(data)
+        quality = {'framing': framing, 'records': len(records), 'bad_time': 0, 'sentinel': 0,
+                   'partial_bytes': max(len(data) - LPC_RECORD_OFFSET, 0) % LPC_RECORD_SIZE}
+        if len(records) > 0:
+            good, quality['bad_time'], quality['sentinel'] = validateLPCrecords(records, struct.unpack_from('>I',data,0)[0])
+            if not good.all():
+                records = records[good]
+        TM['records'] = records
+        TM['quality'] = quality
+    metrics.count('records', len(TM['records']))
+    for key in ('bad_time', 'sentinel', 'partial_bytes'):
+        if quality[key] > 0:
+            metrics.count('quality_' + key, quality[key])
+    if framing != 'length':
+        metrics.count('framing_' + framing)
+    
+    return TM
+
+def writeLPCcsv(TM, OutputFile):
+    ''' Write the records from a TM dict returned by readTM to a human readable csv file '''
+    
+    data = TM['data']
+    bin_header = list(map(str,LPC_DIAMS))
+    
+    with metrics.stage('csv_write'), open(OutputFile, mode='w') as out_file:
         StartTime = struct.unpack_from('>I',data,0)[0] #get the first number which is the start time
         date_time = datetime.fromtimestamp(int(StartTime),tz=timezone.utc)
         d = date_time.strftime("%m/%d/%Y, %H:%M:%S")
-        print("Processing Measurement from: " + d + "To File: " + OutputFile)
+        log.debug('writing csv start=%s file=%s', d, OutputFile)
         
         file_writer = csv.writer(out_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
         
         header1 = ['Instrument: ', 'LPC-0002', 'Measurerment End Time: ', d, 'LASP Optical Particle Counter on Strateole 2 Super Pressure Balloons']
         file_writer.writerow(header1)
         
-        header2 = ['Time', 'Pump1_I','Pump2_I','Heater_I','PHA_I', 'PHA_12V','PHA_3V3',
-                   'Input_V', 'Flow', 'Motor_V', 'Pump1_T', 'Pump2_T',
-                  'Laser_T', 'DC-DC_T', 'Inlet_T'] + bin_header
+        header2 = LPC_HK_FIELDS + bin_header
         file_writer.writerow(header2)
         
-        header3 = ['[Unix Time]', '[mA]','[mA]','[mA]','[mA]', '[V]','[V]',
-                   '[V]', '[SLPM]', '[V]', '[C]', '[C]',
-                  '[C]', '[C]', '[C]'] + ['[diam >nm]']*len(bin_header)
+        header3 = LPC_HK_UNITS + ['[diam >nm]']*len(bin_header)
         file_writer.writerow(header3)
         
-        
-        for y in range(int(len(data)/96 -1)):
-            HGBins = []
-            LGBins = []
-            HKRaw = []
-            HKData = [0]*15
-            indx = 36 + (y+1)*96
-        
-            for x in range(16):
-                HGBins.append(struct.unpack_from('>H',data,indx + x*2)[0])    
-                LGBins.append(struct.unpack_from('>H',data,indx + x*2 + 32)[0])
-                HKRaw.append(struct.unpack_from('>H',data,indx + x*2 + 64)[0])
-
-            HKData[0] = HKRaw[0] + HKRaw[1]*65535  # 16 LSB of time_t
-            HKData[1] = HKRaw[2]  # Pump1 Current in mA
-            HKData[2] = HKRaw[3]  # Pump2 Current in mA
-            HKData[3] = HKRaw[4]  # Heater1 Current in mA
-            HKData[4] = HKRaw[5]  # Detector Current in mA
-            HKData[5] = HKRaw[6] / 1000.0 # Detector voltage in V
-            HKData[6] = HKRaw[7] / 1000.0 # Input Voltage
-            HKData[7] = HKRaw[8] / 1000.0 #Input V
-            HKData[8] = HKRaw[9] / 1000.0 # Flow in SLPM
-            HKData[9] = HKRaw[10] / 1000.0 # Motor voltage in V
-            HKData[10] = HKRaw[11] / 100.0 - 273.15 # Pump1 T in C
-            HKData[11] = HKRaw[12] / 100.0 - 273.15 # Pump2 T in C
-            HKData[12] = HKRaw[13] / 100.0 - 273.15 # Laser T in C
-            HKData[13] = HKRaw[14] / 100.0 - 273.15 # DC-DC T in C
-            HKData[14] = HKRaw[15] / 100.0 - 273.15 # Inlet T in C
-            
-            file_writer.writerow(HKData + HGBins + LGBins)
+        file_writer.writerows(LPCrecordRows(TM['records'], TM.get('HK')))
     
     return OutputFile              
 
+def parseLCPdatatoCSV(InputFile,OutputFile):
+    ''' This function parses the input binary file to a human readable csv file of the same name with a
+    .csv extension'''    
+    
+    return writeLPCcsv(readTM(InputFile), OutputFile)
+
 def plotLPC(filename):
-    ''' This function takes the 'human readable' csv file and generates quick look plots '''
-    
-    mpl.use('Agg')
-    
-    path = os.path.dirname(filename)
-    
-    figFile_size = path + '/plots/' + os.path.splitext(os.path.basename(filename))[0] + '_sizes.png'
-    figFile_hk = path + '/plots/' + os.path.splitext(os.path.basename(filename))[0] + '_HK.png'
-    
-    locs = [0.3,0.5,1.0,2.0,4.0,8.0,16.0]
-    HGBins = np.array([250,275,300,325,350,375,400,450,500,550,600,650,700,750,800,900,1000])
-    LGBins = np.array([1000,1200,1400,1600,1800,2000,2500,3000,3500,4000,6000,8000,10000,13000,16000,24000,24000])
-    diams = np.array([275,300,325,350,375,400,450,500,550,600,650,700,750,800,900,1000,1200,1400,1600,1800,2000,2500,3000,3500,4000,6000,8000,10000,13000,16000,24000,24000])
-    
-    LPCdata = np.genfromtxt(filename, skip_header = 7, delimiter = ',')
-    row = 14
-    dt = LPCdata[row+1,0]- LPCdata[row,0]
-    time = LPCdata[:,0] - LPCdata[0,0]
-    Ipump1 = LPCdata[:,1]
-    Ipump2 = LPCdata[:,2]
-    Pump1_T = LPCdata[:,10]
-    Pump2_T = LPCdata[:,11]
-    LaserT = LPCdata[:,12]
-    DCDC_T = LPCdata[:,13]
-    Inlet_T = LPCdata[:,14]
-    flow = LPCdata[:,8]
-    
-    raw_counts = LPCdata[:,15:]
-    cc_per_sample = flow * 1000*  dt/60
-    counts = raw_counts/cc_per_sample[:,None]
-    dr = np.diff(diams)
-    dr = np.append(dr, dr[-1])
-    dndr = counts/dr
-    title = os.path.basename(filename)
-    
-    fig, ax1 = plt.subplots(figsize = (9,9))
-    ax1.plot(diams/1000, np.mean(dndr,0),'r-')
-    ax1.plot(diams/1000, np.mean(dndr,0) + np.std(dndr,0),'r.')
-    ax1.plot(diams/1000, np.mean(dndr,0) - np.std(dndr,0),'r.')
-    ax1.set_xlabel('Diameter [um]')
-    ax1.set_ylabel('dN/dr [#/cc]')
-    ax1.set_xscale('log')
-    ax1.set_yscale('log')
-    ax1.set_xlim([0.3,24])
-    ax1.set_ylim([1e-8,1])
-    ax1.xaxis.set_minor_locator(ticker.FixedLocator(locs))
-    ax1.xaxis.set_major_locator(ticker.NullLocator())
-    ax1.xaxis.set_minor_formatter(ticker.ScalarFormatter())
-    ax1.set_title(title)
-    plt.savefig(figFile_size)
-    
-    fig, ax2 = plt.subplots()
-    ax2.hist(diams[1:], diams[1:], weights=np.mean(dndr[:,1:],0),histtype='step')
-    ax2.set_xscale('log')
-    ax2.set_yscale('log')
-
-    plt.figure(3,figsize=(9,9))
-    plt.tight_layout()
-    plt.suptitle(title)
-    ax3 = plt.subplot2grid((2,2), (0, 0))
-    ax3.plot(time,Ipump1, 'r-', label = 'Pump1')
-    ax3.plot(time,Ipump2, 'b-', label = 'Pump2')
-    ax3.set_ylim(0,1000)
-    ax3.legend(loc='upper left')
-    ax3.set_ylabel('Current [mA]')
-    ax3.set_xlabel('Elapsed Time [s]')
-    
-    ax4 = plt.subplot2grid((2,2), (0, 1))
-    ax4.plot(time,Pump1_T, 'r-', label = 'Pump1')
-    ax4.plot(time,Pump2_T, 'b-', label = 'Pump2')
-    ax4.legend(loc='upper left')
-    ax4.set_ylabel('Temperature [C]')
-    ax4.set_xlabel('Elapsed Time [s]')
-    
-    ax5 = plt.subplot2grid((2,2), (1, 0))
-    ax5.plot(time,LaserT, 'g-', label = 'Laser')
-    ax5.plot(time,DCDC_T, 'm-', label = 'DCDC Conv.')
-    ax5.plot(time,Inlet_T, 'c-', label = 'Inlet')
-    ax5.legend(loc='upper left')
-    ax5.set_ylabel('Temperature [C]')
-    ax5.set_xlabel('Elapsed Time [s]')
-    
-    ax6 = plt.subplot2grid((2,2), (1, 1))
-    ax6.plot(time,flow, 'k-')
-    ax6.set_ylabel('Flow [SLPM]')
-    ax6.set_xlabel('Elapsed Time [s]')
-    plt.savefig(figFile_hk)
-    
-    plt.close('all')
+    ''' Quick look plots of a 'human readable' csv file, see LPC_Plots.plotLPC '''
+    
+    #imported here as LPC_Plots uses this module and loads matplotlib, which the conversion workers do not need
+    from LPC_Plots import plotLPC
+    return plotLPC(filename)
         
 
 def main():